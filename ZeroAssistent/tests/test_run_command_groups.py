@@ -0,0 +1,30 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import web_app  # noqa: E402
+
+
+def test_env_wrapped_dependent_steps_stay_sequential():
+    cmds = [
+        "env NODE_ENV=production npm install",
+        "env NODE_ENV=production npm run build",
+        "ls",
+        "cat x",
+    ]
+    assert web_app._group_run_commands(cmds) == [
+        ["env NODE_ENV=production npm install"],
+        ["env NODE_ENV=production npm run build"],
+        ["ls", "cat x"],
+    ]
+
+
+def test_state_changing_forms_are_not_parallelized():
+    for cmd in ("date -s 2020-01-01", "hostname other", "printenv PATH", "rg --pre=sh foo", "rg foo --pre sh"):
+        assert web_app._group_run_commands(["ls", cmd, "pwd"]) == [["ls"], [cmd], ["pwd"]], cmd
+
+
+def test_plain_read_only_queries_share_a_batch():
+    cmds = ["date", "hostname", "printenv", "rg foo", "ls -la"]
+    assert web_app._group_run_commands(cmds) == [cmds]
@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import web_app  # noqa: E402
+
+
+def _slow_source():
+    yield "data: a\n\n"
+    time.sleep(0.005)
+    yield "data: b\n\n"
+    time.sleep(1.0)
+    yield "data: c\n\n"
+
+
+def test_buffered_frame_flushed_without_waiting_for_next_frame():
+    start = time.monotonic()
+    arrivals = []
+    for batch in web_app._sse_batch(_slow_source()):
+        arrivals.append((time.monotonic() - start, batch))
+    sent = b"".join(b for _, b in arrivals)
+    assert sent == b"data: a\n\ndata: b\n\ndata: c\n\n"
+    b_at = next(t for t, b in arrivals if b"data: b" in b)
+    # b 在 a 之后 5 ms 到达，被攒进缓冲；应在 25 ms 窗口内下发，而不是等 1 s 后随 c 一起
+    assert b_at < 0.1
+
+
+def test_burst_is_coalesced_and_keepalive_sent_alone():
+    def source():
+        yield web_app._SSE_KEEPALIVE
+        for i in range(50):
+            yield "data: %d\n\n" % i
+
+    batches = list(web_app._sse_batch(source()))
+    assert batches[0] == web_app._SSE_KEEPALIVE_BYTES
+    assert len(batches) < 51
+    assert b"".join(batches[1:]) == "".join("data: %d\n\n" % i for i in range(50)).encode()
+
+
+def test_source_error_is_reraised_after_flushing():
+    def source():
+        yield "data: x\n\n"
+        raise RuntimeError("boom")
+
+    gen = web_app._sse_batch(source())
+    assert next(gen) == b"data: x\n\n"
+    try:
+        next(gen)
+    except RuntimeError as e:
+        assert str(e) == "boom"
+    else:
+        raise AssertionError("expected RuntimeError")
@@ -3,19 +3,31 @@ from __future__ import annotations
 import os
 import re
 import json
+import mmap
+import sqlite3
 import sys
+import codecs
+import functools
+import hashlib
+import importlib.metadata
+import threading
 import tempfile
 import subprocess
 import time
+import unicodedata
 import zipfile
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Callable, Iterator, List, Optional, Tuple
+from typing import Callable, Iterator, List, Optional, Tuple, Union
 from urllib.parse import urlparse, unquote
 import fnmatch
 
 import requests
+from requests.adapters import HTTPAdapter
 from serial.tools import list_ports
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from urllib3.util.retry import Retry
 import shutil
 
 
@@ -59,32 +71,29 @@ def list_serial_devices(force_refresh: bool = False) -> List[dict]:
         ts, cached = _devices_cache
         if now - ts < _DEVICES_CACHE_TTL:
             return cached
-    devices: List[dict] = []
-    for p in list_ports.comports():
-        devices.append(
-            {
-                "device": p.device,  # 如 /dev/cu.usbserial-0001
-                "description": p.description,  # 设备名称
-                "hwid": p.hwid,  # VID/PID 等
-                "manufacturer": getattr(p, "manufacturer", None),
-                "product": getattr(p, "product", None),
-            }
-        )
-
-    # 过滤掉明显不是开发板的串口（如 Mac 的 debug-console、蓝牙虚拟串口）
+    # comports() 已一次性读出各端口的 VID/PID 等属性，逐个端口只是组装字典、没有额外 I/O，
+    # 因此在同一遍遍历中顺带过滤掉明显不是开发板的串口（如 Mac 的 debug-console、蓝牙虚拟串口）
     bad_keywords = ["debug-console", "bluetooth"]
+    devices: List[dict] = []
     filtered: List[dict] = []
-    for d in devices:
+    for p in list_ports.comports():
+        d = {
+            "device": p.device,  # 如 /dev/cu.usbserial-0001
+            "description": p.description,  # 设备名称
+            "hwid": p.hwid,  # VID/PID 等
+            "manufacturer": getattr(p, "manufacturer", None),
+            "product": getattr(p, "product", None),
+        }
+        devices.append(d)
         text = (
-            (d.get("device") or "")
+            (d["device"] or "")
             + " "
-            + (d.get("description") or "")
+            + (d["description"] or "")
             + " "
-            + (d.get("product") or "")
+            + (d["product"] or "")
         ).lower()
-        if any(bad in text for bad in bad_keywords):
-            continue
-        filtered.append(d)
+        if not any(bad in text for bad in bad_keywords):
+            filtered.append(d)
 
     # 如果全被筛掉，就退回原列表，防止用户完全看不到任何设备
     result = filtered or devices
@@ -107,6 +116,24 @@ def guess_esp8266_port(devices: List[dict]) -> Optional[str]:
 # 2. 调用 Qwen Coder 2.5 生成代码
 # =====================
 
+def _build_http_session(
+    user_agent: Optional[str] = None, retries: Union[Retry, int] = 0
+) -> requests.Session:
+    """构造带连接池与 keep-alive 的 Session，重复访问同一站点时复用 TCP/TLS 连接。"""
+    session = requests.Session()
+    if user_agent:
+        session.headers.update({"User-Agent": user_agent})
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# 模型接口与 GitHub API 共用的 Session。不在传输层重试：
+# 模型请求的重试与报错由 _post_chat_with_retry 负责，endpoint 探测需要快速失败
+_API_HTTP = _build_http_session()
+
+
 def extract_code_from_md(text: str) -> str:
     """从可能带 ``` 或 ```python 的内容里提取纯代码"""
     code_blocks = re.findall(r"```(?:[a-zA-Z0-9_+-]+)?\s*([\\s\\S]*?)```", text)
@@ -177,7 +204,7 @@ def _try_endpoint(url: str, headers: dict, provider: str, timeout: int = 8) -> T
         "temperature": 0,
     }
     try:
-        r = requests.post(url, headers=headers, json=payload, timeout=timeout)
+        r = _API_HTTP.post(url, headers=headers, json=payload, timeout=timeout)
         if r.status_code != 200:
             try:
                 body = r.json()
@@ -301,7 +328,7 @@ def _post_chat_with_retry(
     last_err: Exception | None = None
     for attempt in range(retries + 1):
         try:
-            resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
+            resp = _API_HTTP.post(url, headers=headers, json=payload, timeout=timeout)
             resp.raise_for_status()
             return resp
         except requests.exceptions.Timeout as e:
@@ -722,26 +749,59 @@ def get_mentioned_file_paths(instruction: str) -> List[Tuple[str, str]]:
     return candidates
 
 
+@functools.lru_cache(maxsize=8)
+def _allowed_folder_bases_for(root: str) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """
+    按项目根缓存允许的根目录（realpath 需要逐级 lstat，较慢）。
+    返回 (根目录元组, 带末尾分隔符的前缀元组)，前缀可直接传给 str.startswith。
+    """
+    desktop = os.path.realpath(os.path.expanduser("~/Desktop"))
+    bases = [os.path.realpath(root)]
+    if desktop not in bases:
+        bases.append(desktop)
+    return tuple(bases), tuple(b + os.sep for b in bases)
+
+
 def _get_allowed_folder_bases() -> List[str]:
     """返回允许助手操作文件夹的根目录列表（桌面、项目根）。"""
-    desktop = os.path.expanduser("~/Desktop")
-    root = get_project_root()
-    bases = [os.path.realpath(root)]
-    if os.path.realpath(desktop) not in bases:
-        bases.append(os.path.realpath(desktop))
-    return bases
+    return list(_allowed_folder_bases_for(get_project_root())[0])
 
 
-def _is_path_under_allowed_bases(path: str) -> bool:
-    """检查 path 是否在允许的文件夹根目录之下。"""
+# 路径校验结果的缓存时长（秒）：符号链接被改指向后，最多这么久旧结果即过期
+_ALLOWED_PATH_CACHE_TTL = 2
+
+
+@functools.lru_cache(maxsize=256)
+def _resolve_under_bases_bucketed(path: str, root: str, cwd: str, bucket: int) -> Optional[str]:
+    """
+    按 (路径, 项目根, 相对路径所依赖的工作目录, 时间桶) 缓存校验结果，
+    同一批操作反复校验同一路径时省去 realpath 的逐级 lstat。
+    在允许的根目录之下时返回解析后的真实路径，否则返回 None。
+    """
+    try:
+        # realpath 自身会规范化路径，无需再先 normpath 一遍
+        real = os.path.realpath(os.path.join(cwd, path))
+    except OSError:
+        return None
+    bases, prefixes = _allowed_folder_bases_for(root)
+    return real if real in bases or real.startswith(prefixes) else None
+
+
+def _resolve_allowed_path(path: str) -> Optional[str]:
+    """path 在允许的文件夹根目录之下时返回其真实路径（realpath），否则返回 None。"""
     try:
-        real = os.path.realpath(os.path.normpath(path))
+        # 仅相对路径的结果依赖当前工作目录
+        cwd = "" if os.path.isabs(path) else os.getcwd()
     except OSError:
-        return False
-    for base in _get_allowed_folder_bases():
-        if real == base or real.startswith(base + os.sep):
-            return True
-    return False
+        return None
+    return _resolve_under_bases_bucketed(
+        path, get_project_root(), cwd, int(time.time() // _ALLOWED_PATH_CACHE_TTL)
+    )
+
+
+def _is_path_under_allowed_bases(path: str) -> bool:
+    """检查 path 是否在允许的文件夹根目录之下。"""
+    return _resolve_allowed_path(path) is not None
 
 
 def is_path_under_allowed_bases(path: str) -> bool:
@@ -749,6 +809,11 @@ def is_path_under_allowed_bases(path: str) -> bool:
     return _is_path_under_allowed_bases(path)
 
 
+def resolve_allowed_path(path: str) -> Optional[str]:
+    """公开接口：校验并解析 path，在允许的根目录之下时返回真实路径，否则返回 None（校验与解析共用一次 realpath）。"""
+    return _resolve_allowed_path(path)
+
+
 def resolve_folder_path_from_instruction(instruction: str) -> Optional[str]:
     """
     从用户自然语言中解析出文件夹路径并转为绝对路径。
@@ -919,6 +984,10 @@ def write_assistant_results_to_folder(
     if not _is_path_under_allowed_bases(dir_path):
         return False, [f"目录不允许写入：{dir_path}"]
     errors: List[str] = []
+    try:
+        real_dir = os.path.realpath(dir_path)
+    except OSError:
+        return False, [f"目录无效：{dir_path}"]
     for rel, content in file_edits.items():
         rel = rel.replace("\\", "/").lstrip("/")
         if ".." in rel or rel.startswith("/"):
@@ -927,7 +996,6 @@ def write_assistant_results_to_folder(
         full = os.path.join(dir_path, rel)
         try:
             real_full = os.path.realpath(full)
-            real_dir = os.path.realpath(dir_path)
             if real_full != real_dir and not real_full.startswith(real_dir + os.sep):
                 errors.append(f"路径越界：{rel}")
                 continue
@@ -1309,15 +1377,28 @@ def read_file_content_for_assistant(path: str) -> Tuple[bool, str, str]:
     return ok, out, err
 
 
+# 回复解析用的正则，模块加载时编译一次
+_CODE_BLOCK_RE = re.compile(r"```(?:\w*)\s*([\s\S]*?)```")
+_RUN_COMMAND_RE = re.compile(r"---RUN:\s*([^\n\-]+?)\s*---", re.IGNORECASE)
+_FILE_HEADER_RE = re.compile(r"---file:", re.IGNORECASE)
+_MULTI_FILE_RE = re.compile(r"---FILE:\s*([^\n\-]+)---\s*\n([\s\S]*?)(?=---FILE:|---\s*FILE:|$)", re.IGNORECASE)
+
+# 同一条回复在一次请求里会被检测、解析、提取命令多次；按回复文本缓存最近几条的解析结果，
+# 字符串不可变，可变结果（列表/字典）缓存为元组，每次返回新副本
+_REPLY_PARSE_CACHE_SIZE = 16
+
+
+@functools.lru_cache(maxsize=_REPLY_PARSE_CACHE_SIZE)
 def extract_content_to_write_from_reply(reply: str) -> str:
     """从助手回复中提取将要写回文件的内容（与 write 时使用的逻辑一致）。"""
     content = (reply or "").strip()
-    code_blocks = re.findall(r"```(?:\w*)\s*([\s\S]*?)```", content)
+    code_blocks = _CODE_BLOCK_RE.findall(content)
     if code_blocks:
         content = max((b.strip() for b in code_blocks), key=len)
     return content
 
 
+@functools.lru_cache(maxsize=_REPLY_PARSE_CACHE_SIZE)
 def extract_html_from_reply(reply: str) -> Optional[str]:
     """当回复中无 ---FILE:--- 时，若包含整段 HTML（<!DOCTYPE 或 <html ... </html>），则截取返回。"""
     if not (reply or "").strip():
@@ -1350,17 +1431,22 @@ def extract_run_commands_from_reply(reply: str) -> List[str]:
     从助手回复中解析所有 ---RUN: 命令 ---，按出现顺序返回列表。
     复杂项目时 AI 可输出多条 ---RUN:---，系统会依次在项目目录下执行（创建文件夹、安装依赖、编译等）。
     """
-    if not (reply or "").strip():
-        return []
-    text = (reply or "").strip()
-    pattern = re.compile(r"---RUN:\s*([^\n\-]+?)\s*---", re.IGNORECASE)
+    return list(_extract_run_commands_cached(reply or ""))
+
+
+@functools.lru_cache(maxsize=_REPLY_PARSE_CACHE_SIZE)
+def _extract_run_commands_cached(reply: str) -> Tuple[str, ...]:
+    """extract_run_commands_from_reply 的缓存实现，结果为元组。"""
+    if not reply.strip():
+        return ()
+    text = reply.strip()
     commands = []
-    for m in pattern.finditer(text):
+    for m in _RUN_COMMAND_RE.finditer(text):
         cmd = m.group(1).strip()
         if cmd:
             commands.append(cmd)
     if commands:
-        return commands
+        return tuple(commands)
     # 兼容：整条回复只有一行且以常见“只读/查信息”命令开头时，视为要执行的命令
     if "\n" not in text or text.count("\n") == 0:
         first_word = (text.split() or [""])[0].lower()
@@ -1371,8 +1457,28 @@ def extract_run_commands_from_reply(reply: str) -> List[str]:
             "head", "tail", "wc", "file", "stat", "du", "which", "whereis", "find",
             "grep", "rg", "diff", "tree", "ping", "curl", "wget",
         ):
-            return [text]
-    return []
+            return (text,)
+    return ()
+
+
+# 写文件后是否 fsync：默认关闭以换取吞吐（多文件项目创建时逐个落盘代价明显），需要强持久化时设 LUMI_WRITE_FSYNC=1
+_WRITE_FSYNC = os.environ.get("LUMI_WRITE_FSYNC", "").strip().lower() in ("1", "true", "yes")
+_WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+
+
+def _write_text_file(path: str, content: str) -> None:
+    """单次 os.open 后直接写入编码后的字节（与文本模式 open 一致地按平台换行），省去文本缓冲层。"""
+    if os.linesep != "\n":
+        content = content.replace("\n", os.linesep)
+    data = memoryview(content.encode("utf-8"))
+    fd = os.open(path, _WRITE_FLAGS, 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+        if _WRITE_FSYNC:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def write_assistant_result_to_file(
@@ -1433,8 +1539,7 @@ def write_assistant_result_to_file(
         if dir_path:
             os.makedirs(dir_path, exist_ok=True)
         # 直接写入文件
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(content)
+        _write_text_file(path, content)
         return True, ""
     except Exception as e:
         # 如果直接写入失败，回退到命令方式
@@ -1888,7 +1993,7 @@ def call_qwen_assistant_stream(
     except ValueError:
         pass
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=timeout_sec, stream=True)
+        resp = _API_HTTP.post(url, headers=headers, json=payload, timeout=timeout_sec, stream=True)
         resp.raise_for_status()
     except Exception as e:
         # 流式请求失败时回退为非流式，一次性返回完整内容
@@ -1920,6 +2025,96 @@ def call_qwen_assistant_stream(
             continue
 
 
+# 助手回复缓存：同一模式、指令与上下文（且同一模型接口）的回复在有效期内直接复用，省去一次完整的模型请求。
+# 有效期天数由 LUMI_LLM_CACHE_TTL_DAYS 配置（默认 7，设为 0 关闭缓存）
+_LLM_CACHE_PATH = Path.home() / ".lumi_cache" / "llm.sqlite"
+_llm_cache_conn: Optional[sqlite3.Connection] = None
+_llm_cache_lock = threading.Lock()
+
+
+def _llm_cache_ttl_seconds() -> float:
+    try:
+        return max(0.0, float(os.environ.get("LUMI_LLM_CACHE_TTL_DAYS", "7"))) * 86400
+    except ValueError:
+        return 7 * 86400
+
+
+def _llm_cache_db() -> sqlite3.Connection:
+    """返回（必要时创建）缓存库连接；调用方需持有 _llm_cache_lock。"""
+    global _llm_cache_conn
+    if _llm_cache_conn is None:
+        _LLM_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(_LLM_CACHE_PATH), timeout=5, check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS replies (key TEXT PRIMARY KEY, reply TEXT NOT NULL, ts INTEGER NOT NULL)"
+        )
+        conn.commit()
+        _llm_cache_conn = conn
+    return _llm_cache_conn
+
+
+# 缓存键忽略的客套前缀与句末标点：「请帮我做一个贪吃蛇网页。」与「帮我做一个贪吃蛇网页」视为同一请求；
+# 大小写与词间空白会改变生成内容（如标题 Hello World / hello world / HelloWorld），必须保留
+_CACHE_LEAD_RE = re.compile(r"^(?:(?:请你?|麻烦你?|帮我|给我|替我)\s*)+")
+_CACHE_SPACE_RE = re.compile(r"\s+")
+_CACHE_TRAIL_CHARS = "。.!！?？~～…,，"
+
+
+def _normalize_instruction_for_cache(instruction: str) -> str:
+    """
+    归一化指令文本，使仅有措辞细节差异的同一请求落到同一缓存键：
+    NFKC 统一全角/半角，连续空白合并为一个空格，去掉首尾空白、开头的客套词和句末标点；大小写保持不变。
+    """
+    text = unicodedata.normalize("NFKC", instruction or "")
+    text = _CACHE_SPACE_RE.sub(" ", text).strip()
+    text = _CACHE_LEAD_RE.sub("", text)
+    return text.rstrip(_CACHE_TRAIL_CHARS + " ")
+
+
+def llm_cache_key(mode: str, instruction: str, context: Optional[dict] = None) -> str:
+    """按 (模式, 归一化后的指令, 上下文, 当前模型接口与模型名) 计算缓存键。"""
+    info = get_model_provider_info()
+    parts = [
+        mode or "",
+        _normalize_instruction_for_cache(instruction),
+        info.get("provider", ""),
+        info.get("model", ""),
+        json.dumps(context or {}, sort_keys=True, ensure_ascii=False, default=str),
+    ]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def get_cached_llm_reply(key: str) -> Optional[str]:
+    """返回有效期内缓存的回复；未命中、已过期、缓存关闭或读取出错时返回 None。"""
+    ttl = _llm_cache_ttl_seconds()
+    if ttl <= 0:
+        return None
+    try:
+        with _llm_cache_lock:
+            row = _llm_cache_db().execute(
+                "SELECT reply FROM replies WHERE key = ? AND ts >= ?", (key, int(time.time() - ttl))
+            ).fetchone()
+    except (sqlite3.Error, OSError):
+        return None
+    return row[0] if row else None
+
+
+def set_cached_llm_reply(key: str, reply: str) -> None:
+    """写入一条回复缓存，并顺带删除已过期的条目；写入失败不影响主流程。"""
+    ttl = _llm_cache_ttl_seconds()
+    if ttl <= 0 or not reply:
+        return
+    now = int(time.time())
+    try:
+        with _llm_cache_lock:
+            db = _llm_cache_db()
+            db.execute("DELETE FROM replies WHERE ts < ?", (int(now - ttl),))
+            db.execute("INSERT OR REPLACE INTO replies (key, reply, ts) VALUES (?, ?, ?)", (key, reply, now))
+            db.commit()
+    except (sqlite3.Error, OSError):
+        pass
+
+
 def run_assistant_terminal(
     command: str,
     cwd: Optional[str] = None,
@@ -2006,15 +2201,20 @@ def _parse_multi_file_output(text: str) -> dict:
     返回 { "path": "content", ... }，路径统一用 / 分隔。
     若模型先输出设计方案再输出 ---FILE:---，则从第一个 ---FILE: 起截取再解析。
     """
-    if not (text or "").strip():
-        return {}
-    lower = text.lower()
-    idx = lower.find("---file:")
-    if idx > 0:
-        text = text[idx:]
+    return dict(_parse_multi_file_cached(text or ""))
+
+
+@functools.lru_cache(maxsize=_REPLY_PARSE_CACHE_SIZE)
+def _parse_multi_file_cached(text: str) -> Tuple[Tuple[str, str], ...]:
+    """_parse_multi_file_output 的缓存实现，结果为 (路径, 内容) 元组。"""
+    if not text.strip():
+        return ()
+    # 不区分大小写地定位第一个 ---FILE:，不再为整段输出生成 lower() 副本
+    m = _FILE_HEADER_RE.search(text)
+    if m and m.start() > 0:
+        text = text[m.start():]
     out: dict = {}
-    pattern = re.compile(r"---FILE:\s*([^\n\-]+)---\s*\n([\s\S]*?)(?=---FILE:|---\s*FILE:|$)", re.IGNORECASE)
-    for m in pattern.finditer(text):
+    for m in _MULTI_FILE_RE.finditer(text):
         path = m.group(1).strip().replace("\\", "/").lstrip("/")
         content = m.group(2).rstrip()
         if path:
@@ -2024,7 +2224,7 @@ def _parse_multi_file_output(text: str) -> dict:
         stripped = text.strip()
         if stripped:
             out["main.py"] = stripped
-    return out
+    return tuple(out.items())
 
 
 def call_qwen_coder_multi_file(
@@ -2062,11 +2262,31 @@ def call_qwen_coder_multi_file(
 # 3. 行动层：覆写 ESP8266 上的 main.py
 # =====================
 
+def _head_lines(text: str, n: int) -> List[str]:
+    """
+    返回 text 的前 n 行（与 text.splitlines()[:n] 结果一致），
+    只扫描到第 n 个换行为止，不为整段长文本建立完整的行列表。
+    """
+    if n <= 0:
+        return []
+    idx = -1
+    for _ in range(n):
+        idx = text.find("\n", idx + 1)
+        if idx < 0:
+            return text.splitlines()[:n]
+    return text[:idx + 1].splitlines()[:n]
+
+
 def write_temp_code(code: str) -> str:
     """把生成的代码写到临时文件，返回文件路径"""
     fd, path = tempfile.mkstemp(suffix=".py", prefix="esp8266_")
-    with os.fdopen(fd, "w", encoding="utf-8") as f:
-        f.write(code)
+    # mkstemp 已以独占方式新建文件，直接对 fd 写入编码后的字节，不再包一层文本缓冲
+    data = memoryview(code.encode("utf-8"))
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
     return path
 
 
@@ -2277,85 +2497,150 @@ def clear_lumi_cache(logs: Optional[List[str]] = None) -> None:
     if logs is None:
         logs = []
 
-    tmp_root = Path(tempfile.gettempdir())
     prefixes = ("esp8266_", "lumi_pio_", "lumi_arduino_")
     removed = 0
 
-    for child in tmp_root.iterdir():
-        if not any(child.name.startswith(p) for p in prefixes):
-            continue
+    # scandir 一次读出目录项及其类型（多数平台无需逐项 stat），临时目录里无关条目很多时开销明显更小
+    try:
+        with os.scandir(tempfile.gettempdir()) as it:
+            entries = [e for e in it if e.name.startswith(prefixes)]
+    except OSError as e:
+        logs.append(f"读取临时目录失败: {e}")
+        return
+
+    for entry in entries:
         try:
-            if child.is_dir():
-                shutil.rmtree(child, ignore_errors=True)
+            # 不跟随符号链接：指向别处的链接只删除链接本身
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
             else:
                 try:
-                    child.unlink()
+                    os.unlink(entry.path)
                 except FileNotFoundError:
                     pass
             removed += 1
         except Exception as e:
-            logs.append(f"删除缓存失败: {child} -> {e}")
+            logs.append(f"删除缓存失败: {entry.path} -> {e}")
 
     logs.append(f"已清理 {removed} 个 Lumi 缓存条目。")
 
 
-def flash_micropython_main(port: str, src_path: str):
+# 与设备的交互统一走 mpremote 子进程，且每次操作只启动一次（多条子命令以 "+" 串联）。
+# 不在本进程常驻打开串口：网页端、命令行与 REPL 读取都会按需占用同一串口，
+# 常驻句柄会让其他 mpremote 调用因端口被占用而失败，ESP8266 还会在重新打开时因 DTR 复位。
+
+# 探测设备是否运行 MicroPython 的代码片段，输出中应包含 "MPY"
+_MPY_PROBE_CODE = "import sys; print('MPY')"
+
+
+def _mpremote_argv(port: str, *commands: List[str]) -> List[str]:
     """
-    使用 mpremote 把 src_path 上传为板子上的 main.py。
-    在实际拷贝前会先简单检查一次指定串口上是否运行着 MicroPython，
-    如果检测失败，会抛出更友好的错误而不是直接返回晦涩的系统异常。
+    构造一次 mpremote 调用的命令行：多条子命令以 "+" 串联，
+    在同一个进程、同一次串口连接内依次执行，省去每条命令都重新启动解释器、重新打开串口的开销。
+    任一子命令失败时 mpremote 会停止执行后续命令并返回非零退出码。
+    """
+    argv = ["mpremote", "connect", port]
+    for i, cmd in enumerate(commands):
+        if i:
+            argv.append("+")
+        argv.extend(cmd)
+    return argv
+
+
+# mpremote 经 raw REPL 按小块 exec 写文件，115200 波特率下实际吞吐约 1–4 KB/s，按保守值估算超时
+_SERIAL_UPLOAD_BYTES_PER_SEC = 1024
+
+
+def _serial_upload_timeout(nbytes: int, base: int = 15) -> int:
+    """按上传字节数估算 mpremote 拷贝所需的超时（秒），避免大文件在固定超时内传不完。"""
+    return base + nbytes // _SERIAL_UPLOAD_BYTES_PER_SEC
+
+
+def _run_mpremote_batch(port: str, argv: List[str], timeout: int, action: str):
+    """
+    执行一次串联了探测与后续操作的 mpremote 调用，并把失败原因翻译成友好的错误：
+    - stdout 中没有 "MPY"：探测阶段就失败，说明端口上不是 MicroPython 设备；
+    - 有 "MPY" 但退出码非零：探测通过，后续操作（如拷贝）失败。
     """
-    # 先做一次简单探测，避免在非 MicroPython 设备上直接尝试 cp
-    check_cmd = [
-        "mpremote",
-        "connect",
-        port,
-        "exec",
-        "import sys; print('MPY')",
-    ]
-    print("检查 MicroPython 设备:", " ".join(check_cmd))
     try:
-        probe = subprocess.run(
-            check_cmd,
-            check=True,
-            capture_output=True,
-            text=True,
-            timeout=10,
-        )
+        proc = subprocess.run(argv, capture_output=True, text=True, timeout=timeout)
     except FileNotFoundError as e:
         raise RuntimeError("未找到 mpremote 工具，请先通过 pip 安装 mpremote。") from e
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(
-            f"无法在端口 {port} 上检测到 MicroPython 设备，请确认已正确刷入 MicroPython 固件。"
-        ) from e
     except subprocess.TimeoutExpired as e:
         raise RuntimeError(
-            f"检查端口 {port} 上的 MicroPython 状态超时，请确认设备已连接并重试。"
+            f"连接端口 {port} 上的 MicroPython 设备超时，请确认设备已连接并重试。"
         ) from e
 
-    if "MPY" not in (probe.stdout or ""):
+    if "MPY" not in (proc.stdout or ""):
+        if proc.returncode != 0:
+            raise RuntimeError(
+                f"无法在端口 {port} 上检测到 MicroPython 设备，请确认已正确刷入 MicroPython 固件。"
+            )
         raise RuntimeError(
             f"端口 {port} 未返回预期的 MicroPython 响应，请确认该设备已刷入 MicroPython 固件。"
         )
+    if proc.returncode != 0:
+        err = (proc.stderr or proc.stdout or "").strip()
+        raise RuntimeError(
+            f"通过 mpremote 向端口 {port} {action}失败，"
+            f"请检查连接是否稳定或设备是否正在被其他程序占用。（底层错误: {err}）"
+        )
+    return proc
 
-    # 真正执行拷贝
-    cmd = [
-        "mpremote",
-        "connect",
+
+def flash_micropython_main(port: str, src_path: str):
+    """
+    使用 mpremote 把 src_path 上传为板子上的 main.py。
+    拷贝前会先检查一次指定串口上是否运行着 MicroPython（与拷贝串联在同一次 mpremote 调用中），
+    如果检测失败，会抛出更友好的错误而不是直接返回晦涩的系统异常。
+    """
+    # 探测失败时 mpremote 不会继续执行后面的 cp，避免在非 MicroPython 设备上直接拷贝
+    cmd = _mpremote_argv(
         port,
-        "cp",
-        src_path,
-        ":main.py",
-    ]
+        ["exec", _MPY_PROBE_CODE],
+        ["cp", src_path, ":main.py"],
+    )
     print("执行命令:", " ".join(cmd))
     try:
-        subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(
-            f"通过 mpremote 向端口 {port} 烧录 main.py 失败，"
-            f"请检查连接是否稳定或设备是否正在被其他程序占用。（底层错误: {e}）"
-        ) from e
+        size = os.path.getsize(src_path)
+    except OSError:
+        size = 0
+    _run_mpremote_batch(
+        port, cmd, timeout=max(60, _serial_upload_timeout(size)), action="烧录 main.py "
+    )
+
+    print("上传完成，重启板子后会自动运行 main.py")
+
+
+# bytes 字面量不超过该长度的 main.py 直接内联到一次 exec 中写入，无需落地临时文件；
+# 更大的文件走 mpremote cp（ESP8266 空闲内存有限，内联大字符串会编译失败）
+_INLINE_FLASH_MAX_BYTES = 2048
+
 
+def flash_micropython_code(port: str, code: str) -> None:
+    """
+    把内存中的代码烧录为板子上的 main.py。
+    小文件：探测与写入串联在同一次 mpremote 调用中，代码以 bytes 字面量随 exec 发送，不产生临时文件；
+    大文件：写临时文件后交给 flash_micropython_main。
+    """
+    data = code.encode("utf-8")
+    # 按字面量长度判断：非 ASCII 字符会被转义成 \xNN，实际发送量可达原字节数的 4 倍
+    literal = repr(data)
+    if len(literal) > _INLINE_FLASH_MAX_BYTES:
+        tmp_path = write_temp_code(code)
+        try:
+            flash_micropython_main(port, tmp_path)
+        finally:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return
+
+    write_code = f"f=open('main.py','wb')\nf.write({literal})\nf.close()"
+    cmd = _mpremote_argv(port, ["exec", _MPY_PROBE_CODE], ["exec", write_code])
+    print(f"执行命令: mpremote connect {port} exec <probe> + exec <写入 main.py，{len(data)} 字节>")
+    _run_mpremote_batch(port, cmd, timeout=60, action="烧录 main.py ")
     print("上传完成，重启板子后会自动运行 main.py")
 
 
@@ -2365,7 +2650,7 @@ def flash_micropython_files(
     """
     将多文件项目上传到 MicroPython 设备。
     files_dict: { "main.py": "content", "lib/foo.py": "content", ... }
-    会先检测设备是否为 MicroPython，再按路径创建目录并拷贝每个文件。
+    设备检测、目录创建与所有文件拷贝串联在同一次 mpremote 调用中完成。
     """
     if logs is None:
         logs = []
@@ -2374,23 +2659,6 @@ def flash_micropython_files(
         logs.append(msg)
         print(msg)
 
-    # 设备检测（与 flash_micropython_main 一致）
-    check_cmd = ["mpremote", "connect", port, "exec", "import sys; print('MPY')"]
-    try:
-        probe = subprocess.run(
-            check_cmd, check=True, capture_output=True, text=True, timeout=10
-        )
-    except FileNotFoundError as e:
-        raise RuntimeError("未找到 mpremote，请先通过 pip 安装 mpremote。") from e
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(
-            f"无法在端口 {port} 上检测到 MicroPython 设备，请确认已正确刷入 MicroPython 固件。"
-        ) from e
-    if "MPY" not in (probe.stdout or ""):
-        raise RuntimeError(
-            f"端口 {port} 未返回预期的 MicroPython 响应，请确认该设备已刷入 MicroPython 固件。"
-        )
-
     # 收集需要创建的远程目录（路径用 /）
     remote_dirs: set = set()
     for rel_path in files_dict:
@@ -2401,6 +2669,22 @@ def flash_micropython_files(
 
     with tempfile.TemporaryDirectory(prefix="lumi_mpy_") as tmpdir:
         root = Path(tmpdir)
+        commands: List[List[str]] = [["exec", _MPY_PROBE_CODE]]
+
+        # 在设备上创建目录：已存在会抛 OSError，直接忽略；排序保证父目录先于子目录
+        if remote_dirs:
+            mkdir_code = (
+                "import os\n"
+                f"for d in {sorted(remote_dirs)!r}:\n"
+                "    try:\n"
+                "        os.mkdir(d)\n"
+                "    except OSError:\n"
+                "        pass\n"
+            )
+            commands.append(["exec", mkdir_code])
+
+        copied = 0
+        total_bytes = 0
         for rel_path, content in files_dict.items():
             rel_path = rel_path.replace("\\", "/").lstrip("/")
             if not rel_path:
@@ -2408,41 +2692,34 @@ def flash_micropython_files(
             local_path = root / rel_path
             local_path.parent.mkdir(parents=True, exist_ok=True)
             local_path.write_text(content, encoding="utf-8")
-
-        # 在设备上创建目录（mpremote fs mkdir）
-        for d in sorted(remote_dirs):
-            mkdir_cmd = ["mpremote", "connect", port, "fs", "mkdir", ":" + d]
-            try:
-                subprocess.run(mkdir_cmd, capture_output=True, text=True, timeout=10)
-            except Exception:
-                pass  # 已存在会报错，忽略
-
-        for rel_path in files_dict:
-            rel_path = rel_path.replace("\\", "/").lstrip("/")
-            if not rel_path:
-                continue
-            local_path = root / rel_path
-            if not local_path.is_file():
-                continue
+            total_bytes += local_path.stat().st_size
             remote = ":" + rel_path
-            cmd = ["mpremote", "connect", port, "cp", str(local_path), remote]
             log(f"上传 {rel_path} -> 设备 {remote}")
-            try:
-                subprocess.run(cmd, check=True, timeout=30)
-            except subprocess.CalledProcessError as e:
-                raise RuntimeError(
-                    f"上传 {rel_path} 到设备失败: {e}"
-                ) from e
+            commands.append(["cp", str(local_path), remote])
+            copied += 1
+
+        if copied:
+            _run_mpremote_batch(
+                port,
+                _mpremote_argv(port, *commands),
+                timeout=max(10 + 30 * copied, _serial_upload_timeout(total_bytes)),
+                action="上传文件",
+            )
 
     log("多文件上传完成，请重启或复位设备。")
 
 
+@functools.lru_cache(maxsize=8)
+def _resolve_project_root(raw: str) -> str:
+    return os.path.abspath(raw or os.path.expanduser("~/Desktop"))
+
+
 def get_project_root() -> str:
-    """返回项目根目录，用于解析相对路径。默认 ~/Desktop，可通过 LUMI_PROJECT_ROOT 覆盖。"""
-    root = os.environ.get("LUMI_PROJECT_ROOT", "").strip()
-    if not root:
-        root = os.path.expanduser("~/Desktop")
-    return os.path.abspath(root)
+    """
+    返回项目根目录，用于解析相对路径。默认 ~/Desktop，可通过 LUMI_PROJECT_ROOT 覆盖。
+    解析结果按环境变量取值缓存，运行中修改 LUMI_PROJECT_ROOT 仍会立即生效。
+    """
+    return _resolve_project_root(os.environ.get("LUMI_PROJECT_ROOT", "").strip())
 
 
 def _resolve_editable_path(relative_path: str) -> str:
@@ -2521,6 +2798,10 @@ def edit_desktop_file(relative_path: str, user_instruction: str) -> str:
     return new_content
 
 
+# github.com/<owner>/<repo>/blob/<branch>/<path> → raw.githubusercontent.com/<owner>/<repo>/<branch>/<path>
+_GITHUB_BLOB_RE = re.compile(r"^https?://(?:www\.)?github\.com/([^/]+)/([^/]+)/blob/(.+)$")
+
+
 def _to_github_raw_url(url: str) -> str:
     """
     将常见的 GitHub 仓库文件地址转换为 raw 地址。
@@ -2529,11 +2810,10 @@ def _to_github_raw_url(url: str) -> str:
     - https://raw.githubusercontent.com/user/repo/branch/path/to/file.py （原样返回）
     其他 URL 则原样返回。
     """
-    if "raw.githubusercontent.com" in url:
+    # 先做廉价的子串判断，绝大多数非 blob 地址无需进入正则
+    if "github.com" not in url or "/blob/" not in url:
         return url
-    if "github.com" in url and "/blob/" in url:
-        return url.replace("github.com", "raw.githubusercontent.com").replace("/blob/", "/")
-    return url
+    return _GITHUB_BLOB_RE.sub(r"https://raw.githubusercontent.com/\1/\2/\3", url)
 
 
 def download_github_file(url: str) -> str:
@@ -2545,7 +2825,7 @@ def download_github_file(url: str) -> str:
         raise ValueError("URL 不能为空")
 
     raw_url = _to_github_raw_url(url.strip())
-    resp = requests.get(raw_url, timeout=60)
+    resp = _API_HTTP.get(raw_url, timeout=60)
     resp.raise_for_status()
     # 假定是文本文件（MicroPython / Python / 配置等）
     return resp.text
@@ -2556,16 +2836,41 @@ def download_github_file(url: str) -> str:
 # =====================
 
 GITHUB_API = "https://api.github.com"
+# 模型无法给出直链或解析失败时使用的默认搜索词
+_DEFAULT_GITHUB_QUERY = "esp8266 micropython flight controller"
 
 
-def _github_request(path: str, params: Optional[dict] = None) -> dict:
-    """发起 GitHub API 请求（未鉴权 60 次/小时）。"""
-    url = GITHUB_API + path if path.startswith("/") else GITHUB_API + "/" + path
+def _build_github_headers() -> dict:
+    """按当前 GITHUB_TOKEN 构造 GitHub API 请求头。"""
     headers = {"Accept": "application/vnd.github.v3+json"}
     token = os.environ.get("GITHUB_TOKEN")
     if token:
         headers["Authorization"] = f"Bearer {token}"
-    resp = requests.get(url, params=params, headers=headers, timeout=15)
+    return headers
+
+
+# 导入时构造一次，避免每次请求都读环境变量、重建 dict；更换 token 后调用 set_github_token 刷新
+_GITHUB_HEADERS: dict = _build_github_headers()
+
+
+def _refresh_github_headers() -> None:
+    global _GITHUB_HEADERS
+    _GITHUB_HEADERS = _build_github_headers()
+
+
+def set_github_token(token: Optional[str]) -> None:
+    """运行时更换（或清除）GitHub token，并刷新缓存的请求头。"""
+    if token:
+        os.environ["GITHUB_TOKEN"] = token
+    else:
+        os.environ.pop("GITHUB_TOKEN", None)
+    _refresh_github_headers()
+
+
+def _github_request(path: str, params: Optional[dict] = None) -> dict:
+    """发起 GitHub API 请求（未鉴权 60 次/小时）。"""
+    url = GITHUB_API + path if path.startswith("/") else GITHUB_API + "/" + path
+    resp = _API_HTTP.get(url, params=params, headers=_GITHUB_HEADERS, timeout=15)
     resp.raise_for_status()
     return resp.json()
 
@@ -2590,6 +2895,32 @@ def search_github_repositories(q: str, per_page: int = 5) -> List[dict]:
     ]
 
 
+_GITHUB_SEARCH_TTL = 3600  # 搜索结果缓存 1 小时（按时间分桶，跨桶自动失效）
+
+
+@functools.lru_cache(maxsize=16)
+def _search_github_bucketed(q: str, per_page: int, bucket: int) -> tuple:
+    return tuple(search_github_repositories(q, per_page=per_page))
+
+
+def _cached_search(q: str, per_page: int = 5) -> List[dict]:
+    """带 TTL 的 search_github_repositories：同一小时内相同搜索词直接返回缓存结果（请求异常不会被缓存）。"""
+    bucket = int(time.time() // _GITHUB_SEARCH_TTL)
+    return [dict(r) for r in _search_github_bucketed(q, per_page, bucket)]
+
+
+def prewarm_default_github_search() -> None:
+    """在后台线程预取默认搜索词的结果，使首次「从 GitHub 下载并烧录」请求无需等待搜索。"""
+
+    def worker():
+        try:
+            _cached_search(_DEFAULT_GITHUB_QUERY, 5)
+        except Exception:
+            pass
+
+    threading.Thread(target=worker, daemon=True).start()
+
+
 def get_repo_main_file_url(repo_full_name: str, branch: Optional[str] = None) -> Optional[str]:
     """
     获取仓库根目录下的主入口文件（main.py 或第一个 .py 文件）的 raw 下载地址。
@@ -2660,20 +2991,37 @@ def github_search_and_download(instruction: str, logs: Optional[List[str]] = Non
         print(msg)
 
     log("正在解析指令并确定 GitHub 来源…")
+    # 模型解析与默认搜索词的 GitHub 搜索并发进行：模型若最终也给出默认搜索词，直接复用搜索结果
+    executor = ThreadPoolExecutor(max_workers=2)
     try:
-        line = _call_qwen_github_resolve(instruction)
-    except Exception as e:
-        log(f"模型解析失败: {e}，将使用默认搜索词。")
-        line = "SEARCH esp8266 micropython flight controller"
-
-    line = (line or "").strip()
-    if not line:
-        line = "SEARCH esp8266 micropython flight controller"
+        qwen_future = executor.submit(_call_qwen_github_resolve, instruction)
+        search_future = executor.submit(_cached_search, _DEFAULT_GITHUB_QUERY, 5)
+        try:
+            line = qwen_future.result()
+        except Exception as e:
+            log(f"模型解析失败: {e}，将使用默认搜索词。")
+            line = "SEARCH " + _DEFAULT_GITHUB_QUERY
+
+        line = (line or "").strip()
+        if not line:
+            line = "SEARCH " + _DEFAULT_GITHUB_QUERY
+
+        if line.upper().startswith("SEARCH "):
+            query = line[7:].strip() or _DEFAULT_GITHUB_QUERY
+            log(f"使用 GitHub 搜索: {query}")
+            if query.lower() == _DEFAULT_GITHUB_QUERY:
+                repos = search_future.result()
+            else:
+                search_future.cancel()
+                repos = _cached_search(query, per_page=5)
+        else:
+            search_future.cancel()
+            repos = None
+    finally:
+        # 不等待被丢弃的预取搜索，避免直链分支白白多等一次 GitHub 请求
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    if line.upper().startswith("SEARCH "):
-        query = line[7:].strip() or "esp8266 micropython flight controller"
-        log(f"使用 GitHub 搜索: {query}")
-        repos = search_github_repositories(query, per_page=5)
+    if repos is not None:
         if not repos:
             raise RuntimeError("GitHub 未找到匹配的仓库，请换一个描述或稍后重试。")
         for r in repos:
@@ -2695,32 +3043,110 @@ def github_search_and_download(instruction: str, logs: Optional[List[str]] = Non
                 continue
         raise RuntimeError("在已搜索到的仓库中未找到可用的 main.py，请尝试提供具体 GitHub 链接。")
     else:
-        url = line
-        if "raw.githubusercontent.com" not in url and "github.com" in url and "/blob/" in url:
-            url = _to_github_raw_url(url)
-        elif "raw.githubusercontent.com" not in url:
-            url = url.strip()
+        url = _to_github_raw_url(line)
         log(f"正在下载: {url}")
         code = download_github_file(url)
         return code, url
 
 
+# 设置 LUMI_GITHUB_PREWARM=1 时，导入即在后台预取默认搜索结果
+if os.environ.get("LUMI_GITHUB_PREWARM", "").strip().lower() in ("1", "true", "yes"):
+    prewarm_default_github_search()
+
+
 # =====================
 # 自动化脚本工具箱
 # =====================
 
+@functools.lru_cache(maxsize=None)
+def _which(name: str) -> Optional[str]:
+    """缓存版 shutil.which：进程内工具路径基本不变，避免每次遍历 PATH。安装新工具后调用 _which.cache_clear()。"""
+    return shutil.which(name)
+
+
+# 系统「用默认程序打开」的启动命令，导入时确定一次
+if sys.platform == "darwin":
+    _OPEN_CMD = "open"
+elif sys.platform == "win32":
+    _OPEN_CMD = "explorer"
+else:
+    _OPEN_CMD = "xdg-open"
+
+
+def _spawn_detached(cmd: List[str]) -> None:
+    """
+    启动外部程序后立即返回，不等待其退出（open / xdg-open 只负责转交给桌面环境）。
+    子进程放在独立会话中、不继承标准输入输出；启动器本身不存在时抛出 FileNotFoundError。
+    """
+    subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+        close_fds=True,
+    )
+
+
+def _run_streaming(
+    cmd: List[str],
+    logs: Optional[List[str]],
+    timeout: int,
+    cwd: Optional[str] = None,
+    env: Optional[dict] = None,
+    prefix: str = "",
+) -> Tuple[int, str]:
+    """
+    启动耗时命令并逐行读取（stderr 合并进 stdout），每行立即写入 logs 并打印，
+    不必等进程结束才看到输出。返回 (退出码, 完整输出)。
+    超过 timeout 秒会杀掉子进程并抛出 subprocess.TimeoutExpired。
+    """
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+        bufsize=1,
+        cwd=cwd,
+        env=env,
+    )
+    # 读取 stdout 会阻塞，超时由计时器负责杀进程；进程被杀后管道关闭，读取循环随之结束
+    timed_out = threading.Event()
+
+    def _kill():
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, _kill)
+    timer.daemon = True
+    timer.start()
+    buf: List[str] = []
+    try:
+        with proc.stdout:
+            for line in proc.stdout:
+                line = line.rstrip()
+                buf.append(line)
+                if line:
+                    if logs is not None:
+                        logs.append(prefix + line)
+                    print(prefix + line)
+        proc.wait()
+    finally:
+        timer.cancel()
+    output = "\n".join(buf).strip()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout, output=output)
+    return proc.returncode, output
+
+
 def probe_micropython(port: str) -> tuple:
     """检测指定串口是否为 MicroPython 设备。返回 (ok: bool, message: str)"""
     if not port:
         return False, "未指定串口"
     try:
-        check_cmd = [
-            "mpremote",
-            "connect",
-            port,
-            "exec",
-            "import sys; print('MPY')",
-        ]
+        check_cmd = _mpremote_argv(port, ["exec", _MPY_PROBE_CODE])
         proc = subprocess.run(
             check_cmd,
             capture_output=True,
@@ -2741,7 +3167,7 @@ def probe_micropython(port: str) -> tuple:
 def check_platformio_env() -> tuple:
     """检查 PlatformIO 是否可用。返回 (ok: bool, message: str, version: Optional[str])"""
     pio_cmd = os.environ.get("PLATFORMIO", "pio")
-    path = shutil.which(pio_cmd)
+    path = _which(pio_cmd)
     if not path:
         return False, "未找到 PlatformIO（pio），请先安装并加入 PATH。", None
     try:
@@ -2759,18 +3185,70 @@ def check_platformio_env() -> tuple:
         return False, str(e), None
 
 
-def install_missing_dependencies(logs: Optional[List[str]] = None) -> Tuple[bool, str]:
+def _load_requirement_parser():
+    """返回 packaging 的 Requirement 类；未单独安装 packaging 时退回 pip 自带的副本，都没有则返回 None。"""
+    try:
+        from packaging.requirements import Requirement
+    except ImportError:
+        try:
+            from pip._vendor.packaging.requirements import Requirement
+        except ImportError:
+            return None
+    return Requirement
+
+
+def _unsatisfied_requirements(specs: List[str]) -> Optional[List[str]]:
     """
-    检测并自动安装项目所需依赖：先执行 pip install -r requirements.txt，
-    再安装可选包 openai、ruff、platformio。需网络权限。
-    requirements.txt 取自本模块所在目录（即项目/代码根目录），与 LUMI_PROJECT_ROOT 无关。
-    返回 (成功与否, 摘要信息)。
+    用 importlib.metadata 检查依赖是否已满足，返回需要交给 pip 的那部分（可能为空列表）。
+    只是查已安装包的元数据，比让 pip 跑一遍解析器快得多。
+    无法解析（缺少 packaging、含 -r/-e 等选项行或语法不认识）时返回 None，调用方应按原方式整体安装。
     """
-    def log(msg: str):
-        if logs is not None:
-            logs.append(msg)
-        print(msg)
-
+    Requirement = _load_requirement_parser()
+    if Requirement is None:
+        return None
+    missing = []
+    for spec in specs:
+        if spec.startswith("-"):
+            return None
+        try:
+            req = Requirement(spec)
+        except Exception:
+            return None
+        if req.marker is not None and not req.marker.evaluate():
+            continue
+        try:
+            version = importlib.metadata.version(req.name)
+        except importlib.metadata.PackageNotFoundError:
+            missing.append(spec)
+            continue
+        if req.specifier and not req.specifier.contains(version, prereleases=True):
+            missing.append(spec)
+    return missing
+
+
+def _read_requirement_lines(req_path: str) -> List[str]:
+    """读取 requirements.txt 中的有效行（去掉注释与空行）。"""
+    specs = []
+    with open(req_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                specs.append(line)
+    return specs
+
+
+def install_missing_dependencies(logs: Optional[List[str]] = None) -> Tuple[bool, str]:
+    """
+    检测并自动安装项目所需依赖：先 pip install -r requirements.txt，
+    再安装可选包 openai、ruff、platformio（两次 pip 依次执行）。需网络权限。
+    requirements.txt 取自本模块所在目录（即项目/代码根目录），与 LUMI_PROJECT_ROOT 无关。
+    返回 (成功与否, 摘要信息)。
+    """
+    def log(msg: str):
+        if logs is not None:
+            logs.append(msg)
+        print(msg)
+
     # 项目/代码根目录：usb_iot_agent.py 所在目录（此处有 requirements.txt）
     root = os.path.dirname(os.path.abspath(__file__))
     req_path = os.path.join(root, "requirements.txt")
@@ -2779,76 +3257,137 @@ def install_missing_dependencies(logs: Optional[List[str]] = None) -> Tuple[bool
         return False, "项目根目录下无 requirements.txt"
 
     log("正在检测并安装依赖（需联网）…")
-    ok_all = True
-    summary = []
+    # 关闭 pip 版本检查（每次都会额外访问一次 PyPI），优先使用已有 wheel 避免源码编译；
+    # 禁止交互提示（如私有源要求输入凭据），避免在后台卡住直到超时
+    pip_env = dict(os.environ, PIP_DISABLE_PIP_VERSION_CHECK="1", PIP_NO_INPUT="1")
+    pip_base = [sys.executable, "-m", "pip", "install", "--prefer-binary"]
+    optional = ["openai", "ruff", "platformio"]
 
-    # 1. 安装 requirements.txt 中的全部包
-    try:
-        log("[1/2] 执行: pip install -r requirements.txt")
-        proc = subprocess.run(
-            [sys.executable, "-m", "pip", "install", "-r", req_path],
-            capture_output=True,
-            text=True,
-            timeout=300,
-            cwd=root,
+    def _pip(args: List[str], timeout: int, prefix: str) -> Tuple[int, str]:
+        # pip 输出边执行边写入日志（两组安装用 [req]/[opt] 前缀区分）
+        return _run_streaming(
+            pip_base + args, logs, timeout=timeout, cwd=root, env=pip_env, prefix=prefix
         )
-        out = (proc.stdout or "").strip()
-        err = (proc.stderr or "").strip()
-        if out:
-            log(out)
-        if err:
-            log(err)
-        if proc.returncode != 0:
-            ok_all = False
-            summary.append("requirements.txt 安装失败")
-        else:
-            summary.append("requirements.txt 已安装/更新")
-    except subprocess.TimeoutExpired:
-        log("pip install -r requirements.txt 超时（300s）")
-        ok_all = False
-        summary.append("安装超时")
-    except Exception as e:
-        log("执行 pip 失败: %s" % e)
-        ok_all = False
-        summary.append(str(e))
 
-    # 2. 可选包：openai, ruff, platformio
-    optional = ["openai", "ruff", "platformio"]
-    try:
-        log("[2/2] 可选包: %s" % ", ".join(optional))
-        proc = subprocess.run(
-            [sys.executable, "-m", "pip", "install", "-q"] + optional,
-            capture_output=True,
-            text=True,
-            timeout=120,
-            cwd=root,
-        )
-        if proc.returncode != 0 and proc.stderr:
-            log(proc.stderr.strip())
-        if proc.returncode == 0:
-            summary.append("可选包已安装/跳过（已存在）")
-        else:
-            summary.append("部分可选包安装失败（可忽略）")
-    except Exception as e:
-        log("可选包安装异常: %s" % e)
-        summary.append("可选包: %s" % e)
+    # 1. 安装 requirements.txt 中的全部包
+    def _install_requirements() -> Tuple[bool, str]:
+        try:
+            # 先查已安装包的元数据，全部满足时不必启动 pip；否则只安装缺失的部分
+            missing = _unsatisfied_requirements(_read_requirement_lines(req_path))
+            if missing is not None and not missing:
+                return True, "requirements.txt 已满足（跳过 pip）"
+            if missing:
+                log("[req] 需要安装: %s" % ", ".join(missing))
+            returncode, _ = _pip(missing or ["-r", req_path], timeout=300, prefix="[req] ")
+            if returncode != 0:
+                return False, "requirements.txt 安装失败"
+            return True, "requirements.txt 已安装/更新"
+        except subprocess.TimeoutExpired:
+            log("[req] pip install -r requirements.txt 超时（300s）")
+            return False, "安装超时"
+        except Exception as e:
+            log("[req] 执行 pip 失败: %s" % e)
+            return False, str(e)
 
+    # 2. 可选包：openai, ruff, platformio（失败不影响整体结果）
+    def _install_optional() -> Tuple[bool, str]:
+        try:
+            missing = _unsatisfied_requirements(optional)
+            if missing is not None and not missing:
+                return True, "可选包已存在（跳过 pip）"
+            returncode, _ = _pip(["-q"] + (missing or optional), timeout=120, prefix="[opt] ")
+            if returncode == 0:
+                return True, "可选包已安装/跳过（已存在）"
+            return True, "部分可选包安装失败（可忽略）"
+        except Exception as e:
+            log("[opt] 可选包安装异常: %s" % e)
+            return True, "可选包: %s" % e
+
+    # 两组必须依次执行：顶层包名虽不重叠，传递依赖会重叠（platformio 依赖 click/requests/pyserial，
+    # openai 依赖 httpx/anyio 等），pip 进程之间没有锁，并发时可能同时卸载/重装同一发行包而损坏 site-packages
+    log("[req] 执行: pip install -r requirements.txt")
+    ok_all, req_note = _install_requirements()
+    log("[opt] 可选包: %s" % ", ".join(optional))
+    ok_opt, opt_note = _install_optional()
+    ok_all = ok_all and ok_opt
+    summary = [req_note, opt_note]
+
+    # pip 可能新装了 ruff / pio 等命令行工具，清掉路径缓存以便立即生效
+    _which.cache_clear()
+    _load_pdf2docx_converter.cache_clear()
+    with _env_probe_lock:
+        _env_probe_cache.clear()
     msg = "; ".join(summary)
     log("完成: %s" % msg)
     return ok_all, msg
 
 
+# 用户桌面目录，导入时解析一次
+_DESKTOP = Path(os.path.expanduser("~/Desktop"))
+
+
+@functools.lru_cache(maxsize=1)
+def _ensure_desktop() -> Path:
+    """确保桌面目录存在（只在首次调用时 mkdir），返回其 Path。"""
+    _DESKTOP.mkdir(parents=True, exist_ok=True)
+    return _DESKTOP
+
+
 def export_code_to_desktop(code: str, suffix: str = ".py") -> str:
     """将代码导出到桌面，返回写入的绝对路径。"""
-    desktop = Path(os.path.expanduser("~/Desktop"))
-    desktop.mkdir(parents=True, exist_ok=True)
-    stamp = time.strftime("%Y%m%d_%H%M%S")
-    name = f"lumi_export_{stamp}{suffix}"
-    path = desktop / name
-    path.write_text(code, encoding="utf-8")
+    path = _ensure_desktop() / f"lumi_export_{time.strftime('%Y%m%d_%H%M%S')}{suffix}"
+    # 按 UTF-8 字节原样写入，不经文本模式的换行转换
+    path.write_bytes(code.encode("utf-8"))
     return str(path)
 
 
+# 爬取下载专用 Session：带浏览器风格 UA，并对连接/读取错误自动重试
+_CRAWL_HTTP = _build_http_session(
+    user_agent="Mozilla/5.0 (compatible; LumiCrawler/1.0)",
+    retries=Retry(total=2, backoff_factor=0.3),
+)
+
+# 下载落盘时每次读写的块大小
+_COPY_BUFSIZE = 1 << 20
+# 从 Content-Disposition 中取文件名；文件名中不允许出现的字符
+_CD_FILENAME_RE = re.compile(r'filename[*]?=(?:UTF-8\'\')?["\']?([^"\';]+)', re.I)
+_UNSAFE_FS_RE = re.compile(r'[<>:"/\\|?*]')
+
+
+def _advise_sequential(fd: int) -> None:
+    """提示内核该文件将被顺序写入，便于预读/回写合并；不支持的平台（如 Windows）直接跳过。"""
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError):
+        pass
+
+
+# 超过该大小（且未压缩、声明了 Content-Length）的下载走预分配 + readinto 路径
+_LARGE_DOWNLOAD_BYTES = 64 << 20
+
+
+def _copy_large_download(raw, f, length: int) -> None:
+    """
+    大文件落盘：先按 Content-Length 预分配磁盘空间（减少碎片，空间不足时立即失败而不是写到一半），
+    再用同一块 bytearray 反复 readinto，避免每个块都新建 bytes 对象。
+    无论正常读完还是中途抛出异常（连接中断、读超时等），都截断到实际写入的长度，不留预分配的零填充尾部。
+    """
+    try:
+        os.posix_fallocate(f.fileno(), 0, length)
+    except (AttributeError, OSError):
+        pass
+    buf = bytearray(_COPY_BUFSIZE)
+    view = memoryview(buf)
+    try:
+        while True:
+            n = raw.readinto(buf)
+            if not n:
+                break
+            f.write(view[:n])
+    finally:
+        f.truncate(f.tell())
+
+
 def crawl_and_download(
     url: str,
     download_path: str,
@@ -2874,7 +3413,7 @@ def crawl_and_download(
     if not url.startswith(("http://", "https://")):
         return False, "网址需以 http:// 或 https:// 开头"
 
-    base_dir = os.path.expanduser("~/Desktop")
+    base_dir = str(_DESKTOP)
     if (download_path or "").strip():
         raw = os.path.expanduser(download_path.strip())
         if os.path.isdir(raw):
@@ -2890,12 +3429,7 @@ def crawl_and_download(
 
     try:
         log(f"正在请求: {url}")
-        resp = requests.get(
-            url,
-            timeout=timeout_sec,
-            stream=True,
-            headers={"User-Agent": "Mozilla/5.0 (compatible; LumiCrawler/1.0)"},
-        )
+        resp = _CRAWL_HTTP.get(url, timeout=timeout_sec, stream=True)
         resp.raise_for_status()
     except requests.exceptions.Timeout:
         return False, f"请求超时（{timeout_sec}s）"
@@ -2908,14 +3442,14 @@ def crawl_and_download(
         filename = None
         cd = resp.headers.get("Content-Disposition")
         if cd and "filename=" in cd:
-            m = re.search(r'filename[*]?=(?:UTF-8\'\')?["\']?([^"\';]+)', cd, re.I)
+            m = _CD_FILENAME_RE.search(cd)
             if m:
                 filename = unquote(m.group(1).strip().strip('"\''))
         if not filename:
             parsed = urlparse(url)
             path_part = unquote(parsed.path or "")
             filename = os.path.basename(path_part) or "index.html"
-        filename = re.sub(r'[<>:"/\\|?*]', "_", filename)
+        filename = _UNSAFE_FS_RE.sub("_", filename)
         Path(base_dir).mkdir(parents=True, exist_ok=True)
         save_path = os.path.join(base_dir, filename)
 
@@ -2925,16 +3459,40 @@ def crawl_and_download(
 
     try:
         if is_text:
-            text = resp.content.decode(resp.encoding or "utf-8", errors="replace")
-            Path(save_path).write_text(text, encoding="utf-8")
-        else:
-            with open(save_path, "wb") as f:
-                for chunk in resp.iter_content(chunk_size=65536):
+            # 边下载边解码写入，不在内存中拼出完整正文；未声明编码时按 utf-8 解码
+            if not resp.encoding:
+                resp.encoding = "utf-8"
+            with open(save_path, "w", encoding="utf-8", buffering=_COPY_BUFSIZE) as f:
+                for chunk in resp.iter_content(chunk_size=_COPY_BUFSIZE, decode_unicode=True):
                     if chunk:
                         f.write(chunk)
+        else:
+            # 直接从底层连接大块拷贝到文件，省去逐块 Python 循环；decode_content 处理 gzip 等压缩
+            resp.raw.decode_content = True
+            try:
+                length = int(resp.headers.get("Content-Length") or 0)
+            except ValueError:
+                length = 0
+            # 有 Content-Encoding 时 Content-Length 是压缩后的大小，不能用于预分配
+            encoded = (resp.headers.get("Content-Encoding") or "identity").lower() != "identity"
+            with open(save_path, "wb") as f:
+                _advise_sequential(f.fileno())
+                if length >= _LARGE_DOWNLOAD_BYTES and not encoded:
+                    _copy_large_download(resp.raw, f, length)
+                else:
+                    shutil.copyfileobj(resp.raw, f, length=_COPY_BUFSIZE)
         size = os.path.getsize(save_path)
         log(f"已下载完成，大小: {size} 字节")
         return True, save_path
+    except (requests.exceptions.RequestException, Urllib3HTTPError) as e:
+        # 直接读 resp.raw 时连接中断/读超时抛的是 urllib3 异常（不是 OSError），与 requests 异常一并处理；
+        # 下载不完整的文件删掉，避免留下看似完成的残缺文件
+        try:
+            os.remove(save_path)
+        except OSError:
+            pass
+        log(f"下载中断: {e}")
+        return False, f"下载中断: {e}"
     except OSError as e:
         return False, f"写入文件失败: {e}"
 
@@ -2942,15 +3500,22 @@ def crawl_and_download(
 def open_project_root_in_explorer() -> str:
     """在系统文件管理器中打开项目根目录。返回项目根路径。"""
     root = get_project_root()
-    if sys.platform == "darwin":
-        subprocess.run(["open", root], check=True, timeout=5)
-    elif sys.platform == "win32":
-        subprocess.run(["explorer", os.path.normpath(root)], check=True, timeout=5)
-    else:
-        subprocess.run(["xdg-open", root], check=True, timeout=5)
+    _spawn_detached([_OPEN_CMD, os.path.normpath(root)])
     return root
 
 
+# 预览超过该大小的文本文件时只读取开头部分
+_PREVIEW_MAX_BYTES = 512 * 1024
+
+
+def _read_preview_head(path: str, limit: int = _PREVIEW_MAX_BYTES) -> str:
+    """用 mmap 只取文件开头 limit 字节并解码，末尾被截断的半个 UTF-8 字符会被丢弃。"""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        head = mm[:limit]
+    text = codecs.getincrementaldecoder("utf-8")("replace").decode(head, final=False)
+    return text + "\n...（文件较大，已截断预览）"
+
+
 def read_file_for_preview(path: str) -> Tuple[bool, str, str]:
     """读取文件内容供前端预览。仅允许桌面或项目根下的文件。若 path 是目录则尝试读取其下 index.html。返回 (ok, content, error_message)。"""
     path = os.path.normpath(os.path.expanduser(path.strip()))
@@ -2964,6 +3529,13 @@ def read_file_for_preview(path: str) -> Tuple[bool, str, str]:
             return False, "", "该路径是文件夹且其中没有 index.html，请使用「网页预览」在页面内运行"
     if not os.path.isfile(path):
         return False, "", "文件不存在"
+    # 大文本文件不必整份读入（也不必经子进程），直接截取开头供预览
+    if not path.lower().endswith(".docx"):
+        try:
+            if os.path.getsize(path) > _PREVIEW_MAX_BYTES:
+                return True, _read_preview_head(path), ""
+        except (OSError, ValueError):
+            pass
     ok, content, err = read_file_content_for_assistant(path)
     return ok, content or "", err or ""
 
@@ -2976,12 +3548,10 @@ def open_file_in_system(path: str) -> Tuple[bool, str]:
     if not os.path.isfile(path):
         return False, "文件不存在"
     try:
-        if sys.platform == "darwin":
-            subprocess.run(["open", path], check=True, timeout=5)
-        elif sys.platform == "win32":
+        if sys.platform == "win32":
             os.startfile(path)
         else:
-            subprocess.run(["xdg-open", path], check=True, timeout=5)
+            _spawn_detached([_OPEN_CMD, path])
         return True, ""
     except Exception as e:
         return False, str(e)
@@ -2996,12 +3566,7 @@ def open_folder_in_system(path: str) -> Tuple[bool, str]:
     if not os.path.isdir(dir_path):
         return False, "目录不存在"
     try:
-        if sys.platform == "darwin":
-            subprocess.run(["open", dir_path], check=True, timeout=5)
-        elif sys.platform == "win32":
-            subprocess.run(["explorer", os.path.normpath(dir_path)], check=True, timeout=5)
-        else:
-            subprocess.run(["xdg-open", dir_path], check=True, timeout=5)
+        _spawn_detached([_OPEN_CMD, os.path.normpath(dir_path)])
         return True, ""
     except Exception as e:
         return False, str(e)
@@ -3030,7 +3595,7 @@ def open_xcode_project(path: str) -> Tuple[bool, str]:
         return False, "该路径下未找到 .xcodeproj，不是 Xcode 工程"
     try:
         if sys.platform == "darwin":
-            subprocess.run(["open", xcodeproj_path], check=True, timeout=5)
+            _spawn_detached(["open", xcodeproj_path])
             return True, ""
         return False, "仅支持在 macOS 上用 Xcode 打开"
     except Exception as e:
@@ -3043,7 +3608,7 @@ def list_device_files(port: str) -> tuple:
         return False, "未指定串口"
     port = port.strip()
     try:
-        cmd = ["mpremote", "connect", port, "fs", "ls", "/"]
+        cmd = _mpremote_argv(port, ["fs", "ls", "/"])
         proc = subprocess.run(cmd, capture_output=True, text=True, timeout=15)
         if proc.returncode != 0:
             return False, (proc.stderr or proc.stdout or "列出文件失败").strip()
@@ -3062,16 +3627,13 @@ def soft_reset_device(port: str) -> tuple:
         return False, "未指定串口"
     port = port.strip()
     try:
-        cmd = [
-            "mpremote",
-            "connect",
-            port,
-            "exec",
-            "import machine; machine.soft_reset()",
-        ]
-        proc = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+        cmd = _mpremote_argv(port, ["exec", "import machine; machine.soft_reset()"])
+        # 只关心退出码，stdout 直接丢弃，仅保留 stderr 用于报错
+        proc = subprocess.run(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, timeout=10
+        )
         if proc.returncode != 0:
-            return False, (proc.stderr or proc.stdout or "软复位失败").strip()
+            return False, (proc.stderr or "").strip() or "软复位失败"
         return True, f"已向 {port} 发送软复位。"
     except FileNotFoundError:
         return False, "未找到 mpremote，请先通过 pip 安装 mpremote。"
@@ -3092,17 +3654,10 @@ def mip_install_on_device(port: str, package: str, logs: Optional[List[str]] = N
     if not package:
         return False, "未指定要安装的包名（如 umqtt.simple、aioble）"
     try:
-        cmd = ["mpremote", "connect", port, "mip", "install", package]
-        proc = subprocess.run(
-            cmd, capture_output=True, text=True, timeout=120
-        )
-        out = (proc.stdout or "").strip()
-        err = (proc.stderr or "").strip()
-        for line in (out + "\n" + err).strip().splitlines():
-            if line.strip():
-                logs.append(line)
-        if proc.returncode != 0:
-            return False, err or out or "mip 安装失败"
+        cmd = _mpremote_argv(port, ["mip", "install", package])
+        returncode, out = _run_streaming(cmd, logs, timeout=120)
+        if returncode != 0:
+            return False, out or "mip 安装失败"
         return True, f"已在设备 {port} 上安装 {package}。"
     except FileNotFoundError:
         return False, "未找到 mpremote，请先通过 pip 安装 mpremote。"
@@ -3135,17 +3690,10 @@ def read_device_repl(
         % duration_sec
     )
     try:
-        cmd = ["mpremote", "connect", port, "exec", script]
-        proc = subprocess.run(
-            cmd, capture_output=True, text=True, timeout=duration_sec + 15
-        )
-        out = (proc.stdout or "").strip()
-        err = (proc.stderr or "").strip()
-        combined = (out + "\n" + err).strip()
-        for line in combined.splitlines():
-            if line.strip():
-                logs.append(line)
-        return True, combined or "(无输出)"
+        cmd = _mpremote_argv(port, ["exec", script])
+        # 设备每秒打印一次，逐行写入 logs，无需等采样结束再拼接、拆分输出
+        _, out = _run_streaming(cmd, logs, timeout=duration_sec + 15)
+        return True, out or "(无输出)"
     except FileNotFoundError:
         return False, "未找到 mpremote，请先通过 pip 安装 mpremote。"
     except subprocess.TimeoutExpired:
@@ -3169,21 +3717,11 @@ def run_project_script(
         return False, "路径必须在项目根目录下。"
     if not os.path.isfile(path):
         return False, f"文件不存在: {path}"
-    exe = "python3" if shutil.which("python3") else "python"
+    exe = "python3" if _which("python3") else "python"
     try:
-        proc = subprocess.run(
-            [exe, path],
-            cwd=root,
-            capture_output=True,
-            text=True,
-            timeout=60,
-        )
-        out = (proc.stdout or "").strip()
-        err = (proc.stderr or "").strip()
-        for line in (out + "\n" + err).splitlines():
-            logs.append(line)
-        if proc.returncode != 0:
-            return False, err or out or "脚本执行失败"
+        returncode, out = _run_streaming([exe, path], logs, timeout=60, cwd=root)
+        if returncode != 0:
+            return False, out or "脚本执行失败"
         return True, out or "(无标准输出)"
     except FileNotFoundError:
         return False, f"未找到 {exe}，请确保已安装 Python。"
@@ -3200,29 +3738,25 @@ def ruff_check_project(
     if logs is None:
         logs = []
     root = get_project_root()
-    cmd = [shutil.which("ruff") or "ruff", "check", root]
+    cmd = [_which("ruff") or "ruff", "check", root]
     if glob_pattern and glob_pattern.strip():
         cmd.extend(["--glob", glob_pattern.strip()])
     try:
-        proc = subprocess.run(
-            cmd, capture_output=True, text=True, timeout=30
-        )
-        out = (proc.stdout or "").strip()
-        err = (proc.stderr or "").strip()
-        for line in (out + "\n" + err).splitlines():
-            logs.append(line)
-        if proc.returncode != 0:
-            return True, out or err or "ruff 发现部分问题（见上方）。"
+        returncode, out = _run_streaming(cmd, logs, timeout=30)
+        if returncode != 0:
+            return True, out or "ruff 发现部分问题（见上方）。"
         return True, out or "未发现问题。"
     except FileNotFoundError:
         return False, "未找到 ruff，请先安装: pip install ruff"
+    except subprocess.TimeoutExpired:
+        return False, "ruff 检查超时（30s）。"
     except Exception as e:
         return False, str(e)
 
 
 def check_python_env() -> tuple:
     """检查本机 Python 版本。返回 (ok, message, version_str)。"""
-    exe = "python3" if shutil.which("python3") else "python"
+    exe = "python3" if _which("python3") else "python"
     try:
         proc = subprocess.run(
             [exe, "--version"],
@@ -3240,6 +3774,198 @@ def check_python_env() -> tuple:
         return False, str(e), None
 
 
+_ENV_PROBE_TTL = 5.0  # 秒
+_env_probe_cache: dict = {}  # (函数名, 参数) -> (timestamp, result)
+_env_probe_lock = threading.Lock()
+
+
+def _cached_env_probe(fn: Callable, *args):
+    """
+    短 TTL 缓存环境探测结果：界面连续轮询时不必每次都重新启动 pio / python / mpremote 子进程。
+    安装依赖后会清空缓存。
+    """
+    key = (fn.__name__, args)
+    now = time.monotonic()
+    with _env_probe_lock:
+        hit = _env_probe_cache.get(key)
+        if hit is not None and now - hit[0] < _ENV_PROBE_TTL:
+            return hit[1]
+    result = fn(*args)
+    with _env_probe_lock:
+        _env_probe_cache[key] = (time.monotonic(), result)
+    return result
+
+
+def check_environments(ports: Optional[List[str]] = None) -> dict:
+    """
+    并发检查 Python、PlatformIO 以及各串口上的 MicroPython，总耗时约为最慢的一项。
+    返回 {"python": (ok, msg, version), "pio": (ok, msg, version), "mpy": {port: (ok, msg)}}。
+    """
+    ports = [p for p in (ports or []) if p]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        py_fut = pool.submit(_cached_env_probe, check_python_env)
+        pio_fut = pool.submit(_cached_env_probe, check_platformio_env)
+        mpy_futs = {p: pool.submit(_cached_env_probe, probe_micropython, p) for p in ports}
+        return {
+            "python": py_fut.result(),
+            "pio": pio_fut.result(),
+            "mpy": {p: fut.result() for p, fut in mpy_futs.items()},
+        }
+
+
+def _search_with_rg(
+    root: Path,
+    query: str,
+    patterns: Optional[List[str]],
+    ignore_dirs: set,
+    max_matches: int,
+) -> Optional[List[str]]:
+    """
+    用 ripgrep 做固定字符串搜索，结果格式与 Python 扫描一致（"相对路径:行号: 内容"）。
+    系统未安装 rg 或 rg 执行出错时返回 None，由调用方退回逐行扫描。
+    """
+    rg = _which("rg")
+    if not rg:
+        return None
+    # --no-ignore/--hidden：与 Python 扫描保持一致，不受 .gitignore 影响，只排除 ignore_dirs
+    cmd = [
+        rg, "--no-messages", "--no-ignore", "--hidden", "--null",
+        "--line-number", "--no-heading", "--color", "never",
+        "--fixed-strings", "--max-filesize", "2M",
+        "--max-count", str(max_matches),
+    ]
+    for d in sorted(ignore_dirs):
+        cmd += ["--glob", "!" + d]
+    for pat in patterns or []:
+        cmd += ["--glob", pat]
+    cmd += ["-e", query, "."]
+    try:
+        proc = subprocess.run(
+            cmd,
+            cwd=str(root),
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            timeout=30,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    # 退出码 0=有匹配，1=无匹配，其它为出错
+    if proc.returncode not in (0, 1):
+        return None
+
+    matches: List[str] = []
+    for line in (proc.stdout or "").splitlines():
+        # --null：路径后紧跟 \0，避免文件名中的冒号干扰解析
+        path, sep, rest = line.partition("\0")
+        if not sep:
+            continue
+        lineno, _, text = rest.partition(":")
+        if path.startswith(("./", ".\\")):
+            path = path[2:]
+        matches.append(f"{Path(path)}:{lineno}: {text.strip()}")
+        if len(matches) >= max_matches:
+            break
+    return matches
+
+
+def _iter_search_files(root: Path, patterns: Optional[List[str]], ignore_dirs: set):
+    """
+    用 os.scandir 显式栈遍历 root，产出 (路径, DirEntry)。
+    先按文件名做通配过滤，再读取 DirEntry 上缓存的 stat 做 2 MiB 大小过滤，避免对每个文件额外 stat。
+    """
+    stack = [str(root)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in ignore_dirs:
+                            stack.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if patterns and not any(fnmatch.fnmatch(entry.name, pat) for pat in patterns):
+                        continue
+                    if entry.stat().st_size > 2 * 1024 * 1024:
+                        continue
+                except OSError:
+                    continue
+                yield entry.path
+
+
+def _search_with_walk(
+    root: Path,
+    query: str,
+    patterns: Optional[List[str]],
+    ignore_dirs: set,
+    max_matches: int,
+) -> List[str]:
+    """纯 Python 逐文件逐行扫描，作为 ripgrep 不可用时的兜底实现。按字节匹配，只对命中行解码。"""
+    matches: List[str] = []
+    needle = query.encode("utf-8")
+    root_str = str(root)
+
+    for path in _iter_search_files(root, patterns, ignore_dirs):
+        try:
+            with open(path, "rb") as f:
+                for lineno, line in enumerate(f, 1):
+                    if needle in line:
+                        rel = os.path.relpath(path, root_str)
+                        snippet = line.decode("utf-8", "ignore").strip()
+                        matches.append(f"{rel}:{lineno}: {snippet}")
+                        if len(matches) >= max_matches:
+                            return matches
+        except OSError:
+            continue
+    return matches
+
+
+_SEARCH_CACHE_TTL = 30  # 秒
+
+
+def _search_fingerprint(root: Path) -> int:
+    """
+    目录的粗略指纹：根目录及其第一层条目的最大 st_mtime_ns。
+    顶层增删改会立即改变指纹；更深层的修改由 _SEARCH_CACHE_TTL 兜底过期。
+    """
+    try:
+        latest = root.stat().st_mtime_ns
+        with os.scandir(root) as it:
+            for entry in it:
+                try:
+                    latest = max(latest, entry.stat(follow_symlinks=False).st_mtime_ns)
+                except OSError:
+                    continue
+        return latest
+    except OSError:
+        return 0
+
+
+@functools.lru_cache(maxsize=32)
+def _search_bucketed(
+    root: str,
+    query: str,
+    patterns: Optional[Tuple[str, ...]],
+    max_matches: int,
+    fingerprint: int,
+    bucket: int,
+) -> Tuple[str, ...]:
+    ignore_dirs = {".git", ".venv", "__pycache__", "node_modules", ".cursor"}
+    pats = list(patterns) if patterns else None
+    # 优先交给 ripgrep（C 实现、多线程），不可用时再逐文件逐行扫描
+    matches = _search_with_rg(Path(root), query, pats, ignore_dirs, max_matches)
+    if matches is None:
+        matches = _search_with_walk(Path(root), query, pats, ignore_dirs, max_matches)
+    return tuple(matches)
+
+
 def search_in_project(
     query: str,
     glob_pattern: Optional[str],
@@ -3255,40 +3981,24 @@ def search_in_project(
     if not query:
         return False, {"error": "搜索关键字不能为空"}
 
-    ignore_dirs = {".git", ".venv", "__pycache__", "node_modules", ".cursor"}
-    patterns: Optional[List[str]] = None
+    patterns: Optional[Tuple[str, ...]] = None
     if glob_pattern:
-        patterns = [p.strip() for p in glob_pattern.split(",") if p.strip()]
-
-    matches: List[str] = []
-
-    for dirpath, dirnames, filenames in os.walk(root):
-        dirnames[:] = [d for d in dirnames if d not in ignore_dirs]
-        for name in filenames:
-            if patterns:
-                if not any(fnmatch.fnmatch(name, pat) for pat in patterns):
-                    continue
-            path = Path(dirpath) / name
-            try:
-                if path.stat().st_size > 2 * 1024 * 1024:
-                    continue
-            except OSError:
-                continue
-            try:
-                with path.open("r", encoding="utf-8", errors="ignore") as f:
-                    for lineno, line in enumerate(f, 1):
-                        if query in line:
-                            rel = path.relative_to(root)
-                            snippet = line.strip()
-                            matches.append(f"{rel}:{lineno}: {snippet}")
-                            if len(matches) >= max_matches:
-                                break
-                    if len(matches) >= max_matches:
-                        break
-            except OSError:
-                continue
-        if len(matches) >= max_matches:
-            break
+        patterns = tuple(p.strip() for p in glob_pattern.split(",") if p.strip()) or None
+
+    # 同一关键字在目录未变化且 TTL 内重复搜索时直接复用上次结果
+    hits_before = _search_bucketed.cache_info().hits
+    matches = list(
+        _search_bucketed(
+            str(root),
+            query,
+            patterns,
+            max_matches,
+            _search_fingerprint(root),
+            int(time.time() // _SEARCH_CACHE_TTL),
+        )
+    )
+    if _search_bucketed.cache_info().hits > hits_before:
+        logs.append("（命中搜索缓存）")
 
     if not matches:
         logs.append(f"未在 {root} 中搜索到包含「{query}」的内容。")
@@ -3388,6 +4098,20 @@ TOOLBOX_SCRIPTS = [
         "category": "环境",
         "params": [],
     },
+    {
+        "id": "check_env",
+        "name": "一键检查环境",
+        "description": "同时检查 Python、PlatformIO 及各串口上的 MicroPython",
+        "category": "环境",
+        "params": [
+            {
+                "key": "ports",
+                "label": "串口（逗号分隔，留空则检查全部已连接串口）",
+                "type": "string",
+                "optional": True,
+            },
+        ],
+    },
     {
         "id": "list_device_files",
         "name": "列出设备上的文件",
@@ -3479,6 +4203,305 @@ def get_toolbox_scripts() -> List[dict]:
     return list(TOOLBOX_SCRIPTS)
 
 
+def _toolbox_log(logs: List[str], msg: str) -> None:
+    logs.append(msg)
+    print(msg)
+
+
+def _tb_clear_cache(params: dict, logs: List[str]) -> tuple:
+    clear_lumi_cache(logs)
+    return True, {"message": "缓存已清理"}
+
+
+def _tb_refresh_devices(params: dict, logs: List[str]) -> tuple:
+    devices = list_serial_devices()
+    guessed = guess_esp8266_port(devices)
+    _toolbox_log(logs, f"检测到 {len(devices)} 个串口设备")
+    return True, {"devices": devices, "guessed": guessed}
+
+
+def _tb_check_mpy(params: dict, logs: List[str]) -> tuple:
+    port = (params.get("port") or "").strip()
+    ok, msg = probe_micropython(port)
+    _toolbox_log(logs, msg)
+    return ok, {"ok": ok, "message": msg}
+
+
+def _tb_check_pio(params: dict, logs: List[str]) -> tuple:
+    ok, msg, version = check_platformio_env()
+    _toolbox_log(logs, msg)
+    if version:
+        _toolbox_log(logs, version)
+    return ok, {"ok": ok, "message": msg, "version": version}
+
+
+def _tb_export_code(params: dict, logs: List[str]) -> tuple:
+    code = params.get("code") or ""
+    suffix = (params.get("suffix") or ".py").strip()
+    if not suffix.startswith("."):
+        suffix = "." + suffix
+    if not code:
+        _toolbox_log(logs, "未提供代码内容，无法导出。")
+        return False, {"error": "未提供代码"}
+    path = export_code_to_desktop(code, suffix)
+    _toolbox_log(logs, f"已导出到: {path}")
+    return True, {"path": path}
+
+
+def _tb_project_search(params: dict, logs: List[str]) -> tuple:
+    query = (params.get("query") or "").strip()
+    glob_pattern = (params.get("glob") or "").strip() or None
+    ok, data = search_in_project(query, glob_pattern, logs)
+    return ok, data
+
+
+def _tb_show_project_root(params: dict, logs: List[str]) -> tuple:
+    root = get_project_root()
+    _toolbox_log(logs, f"项目根目录: {root}")
+    return True, {"project_root": root}
+
+
+def _tb_open_project_root(params: dict, logs: List[str]) -> tuple:
+    try:
+        root = open_project_root_in_explorer()
+        _toolbox_log(logs, f"已在文件管理器中打开: {root}")
+        return True, {"project_root": root}
+    except Exception as e:
+        _toolbox_log(logs, f"打开失败: {e}")
+        return False, {"error": str(e)}
+
+
+def _tb_ping_model(params: dict, logs: List[str]) -> tuple:
+    result = ping_qwen_model()
+    if result.get("ok"):
+        _toolbox_log(logs, f"模型服务正常，延迟约 {result.get('latency_ms', 0)} ms")
+    else:
+        _toolbox_log(logs, f"模型服务异常: {result.get('error', '未知')}")
+    return result.get("ok", False), result
+
+
+def _tb_check_python(params: dict, logs: List[str]) -> tuple:
+    ok, msg, version = check_python_env()
+    _toolbox_log(logs, msg)
+    if version:
+        _toolbox_log(logs, version)
+    return ok, {"ok": ok, "message": msg, "version": version}
+
+
+def _tb_check_env(params: dict, logs: List[str]) -> tuple:
+    ports = [p.strip() for p in (params.get("ports") or "").split(",") if p.strip()]
+    if not ports:
+        ports = [d["device"] for d in list_serial_devices()]
+    result = check_environments(ports)
+    for label, key in (("Python", "python"), ("PlatformIO", "pio")):
+        ok, msg, version = result[key]
+        _toolbox_log(logs, f"[{label}] {msg}" + (f" {version}" if version else ""))
+    for port, (ok, msg) in result["mpy"].items():
+        _toolbox_log(logs, f"[{port}] {msg}")
+    ok_all = result["python"][0] and result["pio"][0]
+    return ok_all, {
+        "ok": ok_all,
+        "python": {"ok": result["python"][0], "message": result["python"][1], "version": result["python"][2]},
+        "pio": {"ok": result["pio"][0], "message": result["pio"][1], "version": result["pio"][2]},
+        "mpy": {port: {"ok": ok, "message": msg} for port, (ok, msg) in result["mpy"].items()},
+    }
+
+
+def _tb_install_deps(params: dict, logs: List[str]) -> tuple:
+    ok, msg = install_missing_dependencies(logs)
+    return ok, {"message": msg}
+
+
+def _tb_list_device_files(params: dict, logs: List[str]) -> tuple:
+    port = (params.get("port") or "").strip()
+    ok, out = list_device_files(port)
+    _toolbox_log(logs, out)
+    return ok, {"ok": ok, "listing": out}
+
+
+def _tb_soft_reset_device(params: dict, logs: List[str]) -> tuple:
+    port = (params.get("port") or "").strip()
+    ok, msg = soft_reset_device(port)
+    _toolbox_log(logs, msg)
+    return ok, {"ok": ok, "message": msg}
+
+
+def _tb_mip_install(params: dict, logs: List[str]) -> tuple:
+    port = (params.get("port") or "").strip()
+    package = (params.get("package") or "").strip()
+    ok, msg = mip_install_on_device(port, package, logs)
+    _toolbox_log(logs, msg)
+    return ok, {"ok": ok, "message": msg}
+
+
+def _tb_read_device_repl(params: dict, logs: List[str]) -> tuple:
+    port = (params.get("port") or "").strip()
+    duration = (params.get("duration") or "8").strip()
+    try:
+        duration_sec = int(duration) if duration else 8
+    except ValueError:
+        duration_sec = 8
+    ok, output = read_device_repl(port, duration_sec=duration_sec, logs=logs)
+    _toolbox_log(logs, output)
+    return ok, {"ok": ok, "output": output}
+
+
+def _tb_run_project_script(params: dict, logs: List[str]) -> tuple:
+    script_path = (params.get("script_path") or "").strip()
+    ok, output = run_project_script(script_path, logs)
+    _toolbox_log(logs, output)
+    return ok, {"ok": ok, "output": output}
+
+
+def _tb_ruff_check(params: dict, logs: List[str]) -> tuple:
+    glob_pattern = (params.get("glob") or "").strip() or None
+    ok, output = ruff_check_project(glob_pattern, logs)
+    _toolbox_log(logs, output)
+    return ok, {"ok": ok, "output": output}
+
+
+def _tb_python_crawler(params: dict, logs: List[str]) -> tuple:
+    url = (params.get("url") or "").strip()
+    download_path = (params.get("download_path") or "").strip()
+    ok, result = crawl_and_download(url, download_path, logs)
+    if ok:
+        _toolbox_log(logs, f"已保存到: {result}")
+        return True, {"ok": True, "saved_path": result}
+    _toolbox_log(logs, result)
+    return False, {"ok": False, "error": result}
+
+
+# PDF 页数达到该值时启用 pdf2docx 的多进程转换
+_PDF_PARALLEL_MIN_PAGES = 8
+
+
+@functools.lru_cache(maxsize=1)
+def _load_pdf2docx_converter():
+    """
+    首次使用时导入 pdf2docx（会连带导入 PyMuPDF、python-docx 等，较重，不放在模块顶部），
+    结果缓存：未安装时也只查找一次，之后直接返回 None。安装依赖后调用 cache_clear()。
+    """
+    try:
+        from pdf2docx import Converter
+    except ImportError:
+        return None
+    return Converter
+
+
+def _pdf_page_count(pdf_path: str) -> int:
+    """用 PyMuPDF（pdf2docx 的依赖）只打开文档读页数，不解析页面内容；无法读取时返回 0。"""
+    try:
+        import fitz
+    except ImportError:
+        return 0
+    try:
+        with fitz.open(pdf_path) as doc:
+            return doc.page_count
+    except Exception:
+        return 0
+
+
+def _tb_pdf_to_word(params: dict, logs: List[str]) -> tuple:
+    pdf_path = (params.get("pdf_path") or "").strip()
+    output_path = (params.get("output_path") or "").strip()
+    if not pdf_path:
+        _toolbox_log(logs, "未填写 PDF 文件路径")
+        return False, {"error": "未填写 PDF 文件路径"}
+    # 规范化一次后，后缀、所在目录、文件名都从同一个 Path 取，不再反复拆分字符串
+    pdf = Path(os.path.normpath(os.path.expanduser(pdf_path)))
+    pdf_path = str(pdf)
+    # 先做不涉及磁盘的后缀检查，再做允许目录检查，最后才 stat 判断文件是否存在
+    if pdf.suffix.lower() != ".pdf":
+        _toolbox_log(logs, "请指定 .pdf 文件")
+        return False, {"error": "请指定 .pdf 文件"}
+    if not _is_path_under_allowed_bases(pdf_path):
+        _toolbox_log(logs, "仅允许转换桌面或项目根下的 PDF 文件")
+        return False, {"error": "仅允许转换桌面或项目根下的 PDF 文件"}
+    if not pdf.is_file():
+        _toolbox_log(logs, f"文件不存在: {pdf_path}")
+        return False, {"error": f"文件不存在: {pdf_path}"}
+    if output_path:
+        output_path = os.path.normpath(os.path.expanduser(output_path))
+        if not output_path.lower().endswith(".docx"):
+            # normpath 已去掉末尾分隔符，直接拼接扩展名
+            output_path = f"{output_path}.docx"
+        if not _is_path_under_allowed_bases(os.path.abspath(output_path)):
+            _toolbox_log(logs, "仅允许输出到桌面或项目根下")
+            return False, {"error": "仅允许输出到桌面或项目根下"}
+        out_dir = os.path.dirname(output_path)
+        if out_dir:
+            # exist_ok 已覆盖目录存在的情况，无需先 isdir
+            try:
+                os.makedirs(out_dir, exist_ok=True)
+            except OSError as e:
+                _toolbox_log(logs, f"无法创建输出目录: {e}")
+                return False, {"error": str(e)}
+    else:
+        output_path = str(pdf.with_suffix(".docx"))
+    Converter = _load_pdf2docx_converter()
+    if Converter is None:
+        _toolbox_log(logs, "请先安装: pip install pdf2docx")
+        return False, {"error": "请先安装: pip install pdf2docx"}
+    try:
+        # 页数较多时让 pdf2docx 按页分段、多进程并行解析；页数少时进程启动开销反而更大。
+        # 先只读页数再决定走哪条路径，大文件不会先整份读入、解析一遍再丢弃
+        workers = os.cpu_count() or 1
+        pages = _pdf_page_count(pdf_path) if workers > 1 else 0
+        if pages >= _PDF_PARALLEL_MIN_PAGES:
+            # 多进程模式下各子进程按文件名重新打开 PDF，需用路径构造
+            cv = Converter(pdf_path)
+            try:
+                _toolbox_log(logs, f"共 {pages} 页，使用 {workers} 个进程并行转换…")
+                cv.convert(output_path, start=0, end=None, multi_processing=True, cpu_count=workers)
+            finally:
+                cv.close()
+        else:
+            # 单进程：一次性把 PDF 读入内存交给解析器，避免解析过程中对文件的大量零碎读取。
+            # 无缓冲 readall 按文件大小一次分配、一次读完；直接传 bytes，
+            # 避免 PyMuPDF 对 BytesIO 再做一次 getvalue() 整份拷贝
+            with open(pdf_path, "rb", buffering=0) as f:
+                data = f.readall()
+            try:
+                cv = Converter(stream=data)
+            except TypeError:
+                # 旧版 pdf2docx 不支持 stream 参数
+                cv = Converter(pdf_path)
+            try:
+                cv.convert(output_path, start=0, end=None)
+            finally:
+                cv.close()
+        _toolbox_log(logs, f"已转换: {output_path}")
+        return True, {"ok": True, "output_path": output_path}
+    except Exception as e:
+        _toolbox_log(logs, f"转换失败: {e}")
+        return False, {"error": str(e)}
+
+
+# script_id -> 处理函数 (params, logs) -> (ok, data)
+_TOOLBOX_HANDLERS: dict = {
+    "clear_cache": _tb_clear_cache,
+    "refresh_devices": _tb_refresh_devices,
+    "check_mpy": _tb_check_mpy,
+    "check_pio": _tb_check_pio,
+    "export_code": _tb_export_code,
+    "project_search": _tb_project_search,
+    "show_project_root": _tb_show_project_root,
+    "open_project_root": _tb_open_project_root,
+    "ping_model": _tb_ping_model,
+    "check_python": _tb_check_python,
+    "check_env": _tb_check_env,
+    "install_deps": _tb_install_deps,
+    "list_device_files": _tb_list_device_files,
+    "soft_reset_device": _tb_soft_reset_device,
+    "mip_install": _tb_mip_install,
+    "read_device_repl": _tb_read_device_repl,
+    "run_project_script": _tb_run_project_script,
+    "ruff_check": _tb_ruff_check,
+    "python_crawler": _tb_python_crawler,
+    "pdf_to_word": _tb_pdf_to_word,
+}
+
+
 def run_toolbox_script(
     script_id: str,
     params: dict,
@@ -3488,185 +4511,10 @@ def run_toolbox_script(
     执行指定工具箱脚本。返回 (ok: bool, data: Optional[dict])。
     logs 会被追加执行过程信息。
     """
-    def log(msg: str):
-        logs.append(msg)
-        print(msg)
-
-    if script_id == "clear_cache":
-        clear_lumi_cache(logs)
-        return True, {"message": "缓存已清理"}
-
-    if script_id == "refresh_devices":
-        devices = list_serial_devices()
-        guessed = guess_esp8266_port(devices)
-        log(f"检测到 {len(devices)} 个串口设备")
-        return True, {"devices": devices, "guessed": guessed}
-
-    if script_id == "check_mpy":
-        port = (params.get("port") or "").strip()
-        ok, msg = probe_micropython(port)
-        log(msg)
-        return ok, {"ok": ok, "message": msg}
-
-    if script_id == "check_pio":
-        ok, msg, version = check_platformio_env()
-        log(msg)
-        if version:
-            log(version)
-        return ok, {"ok": ok, "message": msg, "version": version}
-
-    if script_id == "export_code":
-        code = params.get("code") or ""
-        suffix = (params.get("suffix") or ".py").strip()
-        if not suffix.startswith("."):
-            suffix = "." + suffix
-        if not code:
-            log("未提供代码内容，无法导出。")
-            return False, {"error": "未提供代码"}
-        path = export_code_to_desktop(code, suffix)
-        log(f"已导出到: {path}")
-        return True, {"path": path}
-
-    if script_id == "project_search":
-        query = (params.get("query") or "").strip()
-        glob_pattern = (params.get("glob") or "").strip() or None
-        ok, data = search_in_project(query, glob_pattern, logs)
-        return ok, data
-
-    if script_id == "show_project_root":
-        root = get_project_root()
-        log(f"项目根目录: {root}")
-        return True, {"project_root": root}
-
-    if script_id == "open_project_root":
-        try:
-            root = open_project_root_in_explorer()
-            log(f"已在文件管理器中打开: {root}")
-            return True, {"project_root": root}
-        except Exception as e:
-            log(f"打开失败: {e}")
-            return False, {"error": str(e)}
-
-    if script_id == "ping_model":
-        result = ping_qwen_model()
-        if result.get("ok"):
-            log(f"模型服务正常，延迟约 {result.get('latency_ms', 0)} ms")
-        else:
-            log(f"模型服务异常: {result.get('error', '未知')}")
-        return result.get("ok", False), result
-
-    if script_id == "check_python":
-        ok, msg, version = check_python_env()
-        log(msg)
-        if version:
-            log(version)
-        return ok, {"ok": ok, "message": msg, "version": version}
-
-    if script_id == "install_deps":
-        ok, msg = install_missing_dependencies(logs)
-        return ok, {"message": msg}
-
-    if script_id == "list_device_files":
-        port = (params.get("port") or "").strip()
-        ok, out = list_device_files(port)
-        log(out)
-        return ok, {"ok": ok, "listing": out}
-
-    if script_id == "soft_reset_device":
-        port = (params.get("port") or "").strip()
-        ok, msg = soft_reset_device(port)
-        log(msg)
-        return ok, {"ok": ok, "message": msg}
-
-    if script_id == "mip_install":
-        port = (params.get("port") or "").strip()
-        package = (params.get("package") or "").strip()
-        ok, msg = mip_install_on_device(port, package, logs)
-        log(msg)
-        return ok, {"ok": ok, "message": msg}
-
-    if script_id == "read_device_repl":
-        port = (params.get("port") or "").strip()
-        duration = (params.get("duration") or "8").strip()
-        try:
-            duration_sec = int(duration) if duration else 8
-        except ValueError:
-            duration_sec = 8
-        ok, output = read_device_repl(port, duration_sec=duration_sec, logs=logs)
-        log(output)
-        return ok, {"ok": ok, "output": output}
-
-    if script_id == "run_project_script":
-        script_path = (params.get("script_path") or "").strip()
-        ok, output = run_project_script(script_path, logs)
-        log(output)
-        return ok, {"ok": ok, "output": output}
-
-    if script_id == "ruff_check":
-        glob_pattern = (params.get("glob") or "").strip() or None
-        ok, output = ruff_check_project(glob_pattern, logs)
-        log(output)
-        return ok, {"ok": ok, "output": output}
-
-    if script_id == "python_crawler":
-        url = (params.get("url") or "").strip()
-        download_path = (params.get("download_path") or "").strip()
-        ok, result = crawl_and_download(url, download_path, logs)
-        if ok:
-            log(f"已保存到: {result}")
-            return True, {"ok": True, "saved_path": result}
-        log(result)
-        return False, {"ok": False, "error": result}
-
-    if script_id == "pdf_to_word":
-        pdf_path = (params.get("pdf_path") or "").strip()
-        output_path = (params.get("output_path") or "").strip()
-        if not pdf_path:
-            log("未填写 PDF 文件路径")
-            return False, {"error": "未填写 PDF 文件路径"}
-        pdf_path = os.path.normpath(os.path.expanduser(pdf_path))
-        if not os.path.isfile(pdf_path):
-            log(f"文件不存在: {pdf_path}")
-            return False, {"error": f"文件不存在: {pdf_path}"}
-        if not pdf_path.lower().endswith(".pdf"):
-            log("请指定 .pdf 文件")
-            return False, {"error": "请指定 .pdf 文件"}
-        if not _is_path_under_allowed_bases(pdf_path):
-            log("仅允许转换桌面或项目根下的 PDF 文件")
-            return False, {"error": "仅允许转换桌面或项目根下的 PDF 文件"}
-        if output_path:
-            output_path = os.path.normpath(os.path.expanduser(output_path))
-            if not output_path.lower().endswith(".docx"):
-                output_path = output_path.rstrip("/") + ".docx"
-            out_dir = os.path.dirname(output_path)
-            if out_dir and not os.path.isdir(out_dir):
-                try:
-                    os.makedirs(out_dir, exist_ok=True)
-                except OSError as e:
-                    log(f"无法创建输出目录: {e}")
-                    return False, {"error": str(e)}
-            if not _is_path_under_allowed_bases(os.path.abspath(output_path)):
-                log("仅允许输出到桌面或项目根下")
-                return False, {"error": "仅允许输出到桌面或项目根下"}
-        else:
-            out_dir = os.path.dirname(pdf_path)
-            stem = os.path.splitext(os.path.basename(pdf_path))[0]
-            output_path = os.path.join(out_dir, stem + ".docx")
-        try:
-            from pdf2docx import Converter
-            cv = Converter(pdf_path)
-            cv.convert(output_path, start=0, end=None)
-            cv.close()
-            log(f"已转换: {output_path}")
-            return True, {"ok": True, "output_path": output_path}
-        except ImportError:
-            log("请先安装: pip install pdf2docx")
-            return False, {"error": "请先安装: pip install pdf2docx"}
-        except Exception as e:
-            log(f"转换失败: {e}")
-            return False, {"error": str(e)}
-
-    return False, {"error": f"未知脚本: {script_id}"}
+    handler = _TOOLBOX_HANDLERS.get(script_id)
+    if handler is None:
+        return False, {"error": f"未知脚本: {script_id}"}
+    return handler(params, logs)
 
 
 # =====================
@@ -3680,9 +4528,14 @@ def interactive_agent():
         print("未检测到任何串口设备，请检查 USB 连接。")
         return
 
-    print("检测到以下串口设备：")
-    for i, d in enumerate(devices):
-        print(f"[{i}] {d['device']}  {d['description']}  ({d.get('manufacturer') or ''})")
+    # 拼成一段后一次性输出，避免每行一次 write
+    print(
+        "检测到以下串口设备：\n"
+        + "\n".join(
+            f"[{i}] {d['device']}  {d['description']}  ({d.get('manufacturer') or ''})"
+            for i, d in enumerate(devices)
+        )
+    )
 
     guessed = guess_esp8266_port(devices)
     print()
@@ -3725,27 +4578,28 @@ def interactive_agent():
     full_instruction = user_goal + extra_hardware_context
 
     print("\\n正在调用 Qwen Coder 2.5 生成 MicroPython 代码，请稍候...")
-    code = call_qwen_coder(full_instruction)
-    print("\\n===== 生成的 main.py 代码预览（前 80 行） =====")
-    for i, line in enumerate(code.splitlines()[:80], 1):
-        print(f"{i:3}: {line}")
-    print("=============================================")
+    # 等待模型生成的同时探测串口上的 MicroPython，设备有问题时可在确认写入前就提示
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        code_future = pool.submit(call_qwen_coder, full_instruction)
+        probe_future = pool.submit(probe_micropython, port)
+        code = code_future.result()
+        probe_ok, probe_msg = probe_future.result()
+    print(
+        "\\n===== 生成的 main.py 代码预览（前 80 行） =====\n"
+        + "\n".join(f"{i:3}: {line}" for i, line in enumerate(_head_lines(code, 80), 1))
+        + "\n============================================="
+    )
     print()
+    if not probe_ok:
+        print(f"注意：{probe_msg}")
 
     confirm = input("是否将此代码覆写到 ESP8266 的 main.py？(y/N): ").strip().lower()
     if confirm != "y":
         print("用户取消写入。")
         return
 
-    # 3. 写临时文件并上传
-    tmp_path = write_temp_code(code)
-    try:
-        flash_micropython_main(port, tmp_path)
-    finally:
-        try:
-            os.remove(tmp_path)
-        except OSError:
-            pass
+    # 3. 上传（小文件直接从内存写入，不经临时文件）
+    flash_micropython_code(port, code)
 
     print("已完成本次 Agent 行动。请重启板子或复位观察效果。")
 
@@ -1,16 +1,24 @@
 from __future__ import annotations
 
+import atexit
+import functools
+import hashlib
+import heapq
+import json
 import os
+import queue
 import re
 import shutil
 import sys
 import threading
 import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait as futures_wait
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Iterator, List, Optional, Tuple
 
-from flask import Flask, Response, jsonify, render_template, request, send_from_directory, stream_with_context
+from flask import Flask, Response, abort, jsonify, render_template, request, send_file, stream_with_context
 
 # 一些 Windows + Python 组合下，Flask 在启动时会调用 socket.getfqdn(host)
 # 若主机名或反向解析结果包含非 UTF-8 字节，可能触发 UnicodeDecodeError 导致服务无法启动。
@@ -58,11 +66,11 @@ from usb_iot_agent import (
     write_assistant_results_to_folder,
     ensure_directory_and_write_files,
     _parse_multi_file_output,
+    _head_lines,
     extract_run_command_from_reply,
     extract_run_commands_from_reply,
     infer_assistant_mode,
-    write_temp_code,
-    flash_micropython_main,
+    flash_micropython_code,
     flash_micropython_files,
     build_and_upload_platformio,
     clear_lumi_cache,
@@ -73,21 +81,477 @@ from usb_iot_agent import (
     edit_file_preview,
     edit_file_apply,
     get_project_root,
-    is_path_under_allowed_bases,
+    resolve_allowed_path,
     read_file_for_preview,
     open_file_in_system,
     open_folder_in_system,
     open_xcode_project,
     download_github_file,
     github_search_and_download,
+    llm_cache_key,
+    get_cached_llm_reply,
+    set_cached_llm_reply,
 )
 
-# 网页内预览：preview_id -> 项目根目录绝对路径（仅允许桌面/项目根下）
-_preview_roots: dict = {}
+# 电脑助手指令识别用的正则，模块加载时编译一次
+_CREATE_APP_RE = re.compile(r"(?:做|开发).*(?:软件|应用|App)", re.IGNORECASE)
+# 创建类请求：同时提到「做/开发」与「网站/软件/…」（先后不限），或含 app（不区分大小写）
+_CREATE_INTENT_RE = re.compile(
+    r"^(?=.*?(?:做|开发))(?=.*?(?:网站|软件|应用|网页|小游戏))|app", re.IGNORECASE | re.DOTALL
+)
+# 模型回复中的多文件标记与代码/HTML 标记：不区分大小写直接搜索，不再为整段回复生成 upper()/lower() 副本
+_FILE_MARKER_RE = re.compile(r"---FILE:", re.IGNORECASE)
+_CODE_MARKER_RE = re.compile(r"```|<!DOCTYPE|<html", re.IGNORECASE)
+# 无需调用大模型即可直接答复的简单指令（整句匹配）：打开已指定的文件/文件夹。
+# 不在服务端直答时间/日期：部署实例的时区（Docker 默认 UTC）未必是用户所在时区
+_DIRECT_OPEN_FILE_RE = re.compile(r"^(?:请|帮我)?(?:打开|预览)(?:一下)?(?:它|这个文件|该文件|文件)?[。.!！]?$")
+_DIRECT_OPEN_FOLDER_RE = re.compile(r"^(?:请|帮我)?打开(?:一下)?(?:这个|该)?文件夹[。.!！]?$")
+# 文件夹批量修改的文件类型：一次扫描取出指令中提到的所有扩展名
+_FOLDER_EXT_RE = re.compile(
+    r"\.(py|txt|js|ts|jsx|tsx|html|css)|(py|txt)\s*文件|所有\s*\.?(py|txt)", re.IGNORECASE
+)
+# 「从 GitHub 下载并烧录」类指令的两组关键词
+_GH_FETCH_RE = re.compile("下载|拉取|获取|找|搜索")
+_GH_FLASH_RE = re.compile("烧录|烧写|上传|刷入|写入设备")
+
+# 进程退出时置位，通知后台定时线程结束等待并退出
+_background_stop = threading.Event()
+atexit.register(_background_stop.set)
+
+# 网页内预览：preview_id -> (项目根目录绝对路径, 根目录加分隔符的前缀)（仅允许桌面/项目根下）
+# 按最近使用排序，超过 _PREVIEW_ROOTS_MAX 个时淘汰最久未用的，长时间运行不会无限增长
+_PREVIEW_ROOTS_MAX = 512
+_preview_roots: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+_preview_roots_lock = threading.Lock()
+
+# 最近一次设备列表及其推测端口：list_serial_devices 在 TTL 内返回同一个列表对象，
+# 列表未变时直接复用推测结果，页面加载时的多次请求只推测一次
+_devices_guess_cache: Optional[tuple] = None  # (devices, guessed)
+_devices_guess_lock = threading.Lock()
+
+
+def _devices_and_guess(force_refresh: bool = False) -> Tuple[List[dict], Optional[str]]:
+    """返回 (串口设备列表, 推测的 ESP8266 端口)。"""
+    global _devices_guess_cache
+    devices = list_serial_devices(force_refresh=force_refresh)
+    with _devices_guess_lock:
+        cached = _devices_guess_cache
+        if cached is not None and cached[0] is devices:
+            return cached
+        guessed = guess_esp8266_port(devices) if devices else None
+        _devices_guess_cache = (devices, guessed)
+    return devices, guessed
+
+
+def _folder_edit_pattern(instruction: str) -> str:
+    """按指令中提到的文件类型选择批量修改的匹配模式：py 优先，其次 txt，再次第一个出现的网页类扩展名。"""
+    exts = [
+        next(g for g in m.groups() if g).lower() for m in _FOLDER_EXT_RE.finditer(instruction)
+    ]
+    if "py" in exts:
+        return "*.py"
+    if "txt" in exts:
+        return "*.txt"
+    return "*." + exts[0] if exts else "*"
+
+
+def _cached_reply(mode: str, instruction: str, context: dict, no_cache: bool) -> Tuple[Optional[str], Optional[str]]:
+    """
+    查询创建类请求的回复缓存，返回 (缓存键, 命中的回复)。
+    no_cache 时返回 (None, None)，既不读也不写缓存；调用方在项目创建成功后用缓存键写回模型回复。
+    """
+    if no_cache:
+        return None, None
+    key = llm_cache_key(mode, instruction, context)
+    return key, get_cached_llm_reply(key)
+
+
+def _json_body() -> dict:
+    """
+    解析请求体 JSON（不校验 Content-Type），解析结果只用一次，不在 request 上缓存。
+    请求体不是 JSON 对象（如数组、字符串、null）时按空对象处理，各接口随后按缺少字段返回 400，
+    而不是在 data.get 上抛 AttributeError 变成 500。
+    """
+    data = request.get_json(force=True, cache=False)
+    return data if isinstance(data, dict) else {}
+
+
+# 当前用户主目录与桌面，进程内不变，启动时解析一次
+_HOME_DIR = os.path.expanduser("~")
+_DESKTOP_DIR = os.path.join(_HOME_DIR, "Desktop")
+
+
+def _expand_home(path: str) -> str:
+    """展开路径开头的 ~；常见的 ~ 与 ~/ 直接拼接主目录，~user 等其他写法交给 expanduser。"""
+    if path == "~":
+        return _HOME_DIR
+    if path.startswith("~/"):
+        return os.path.join(_HOME_DIR, path[2:])
+    if path.startswith("~"):
+        return os.path.expanduser(path)
+    return path
+
+
+# 同一时刻至多一个后台接口探测；探测本身（含 60 秒缓存）由 _get_working_endpoint 负责
+_endpoint_probe_lock = threading.Lock()
+
+
+def _refresh_endpoint_in_background() -> None:
+    """
+    在后台线程探测一次可用的模型接口并写入缓存，不阻塞调用方。
+    缓存未过期时 _get_working_endpoint 直接返回，不会产生网络请求；已有探测在进行时直接跳过。
+    """
+    if not _endpoint_probe_lock.acquire(blocking=False):
+        return
+
+    def worker():
+        try:
+            _get_working_endpoint()
+        except Exception:
+            pass
+        finally:
+            _endpoint_probe_lock.release()
+
+    threading.Thread(target=worker, daemon=True).start()
+
+
+def _llm_concurrency() -> int:
+    """同时进行的大模型调用上限，可通过 LUMI_LLM_CONCURRENCY 调整（默认 8）。"""
+    try:
+        return max(1, int(os.environ.get("LUMI_LLM_CONCURRENCY", "8")))
+    except ValueError:
+        return 8
+
+
+# 非流式的大模型调用统一在该线程池中执行：并发数有明确上限，慢模型不会把所有请求线程同时压在上游接口上；
+# 线程池中的调用共用 usb_iot_agent 里带连接池的 HTTP 会话
+_LLM_POOL = ThreadPoolExecutor(max_workers=_llm_concurrency(), thread_name_prefix="llm")
+
+
+def _llm_call(fn, *args, **kwargs):
+    """在大模型线程池中执行一次阻塞调用并等待结果，异常原样抛给调用方。"""
+    return _LLM_POOL.submit(fn, *args, **kwargs).result()
+
+
+def _head_preview(text: str, max_lines: int, max_chars: Optional[int] = None) -> Tuple[str, bool]:
+    """
+    生成带行号的前 max_lines 行预览，只扫描到所需行数为止，不为整段代码建立完整行列表。
+    返回 (预览文本, 是否还有更多行)；给定 max_chars 时超长部分截断并标注。
+    """
+    lines = _head_lines(text, max_lines + 1)
+    preview = "\n".join(f"{i:3}: {line}" for i, line in enumerate(lines[:max_lines], 1))
+    if max_chars is not None and len(preview) > max_chars:
+        preview = preview[:max_chars] + "\n...(预览已截断)"
+    return preview, len(lines) > max_lines
+
+
+# SSE 事件序列化：复用同一个编码器实例。json.dumps 传入非默认参数时每次调用都会新建 JSONEncoder
+_sse_json_encode = json.JSONEncoder(ensure_ascii=False).encode
+
+
+# 预览目录是 Xcode 工程时返回的说明页，内容固定，模块加载时编码一次
+_XCODE_PREVIEW_HTML = (
+    "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Xcode 项目</title></head><body style=\"font-family:system-ui;padding:2rem;max-width:36em;margin:0 auto;\">"
+    "<h2>这是 Xcode 项目</h2>"
+    "<p>iOS/macOS 应用无法在浏览器中预览。</p>"
+    "<p>请关闭本窗口，在右侧「对话中提到的文件」中点击<strong>「打开」</strong>在 Finder 中打开该文件夹，然后双击 <code>.xcodeproj</code> 用 Xcode 打开并运行。</p>"
+    "<p>或点击<strong>「用 Xcode 打开」</strong>直接启动 Xcode 并打开该工程。</p>"
+    "</body></html>"
+).encode("utf-8")
+
+
+# 预览根目录列表的缓存时长（秒）：iframe 探测 favicon.ico 等不存在的文件时，短时间内不重复扫描目录
+_PREVIEW_LISTDIR_TTL = 2
+
+
+@functools.lru_cache(maxsize=512)
+def _listdir_bucketed(root: str, bucket: int) -> Tuple[str, ...]:
+    """按 (目录, 时间桶) 缓存排好序的目录项；OSError 不缓存，直接抛给调用方。"""
+    return tuple(sorted(os.listdir(root)))
+
+
+def _cached_listdir(root: str) -> Tuple[str, ...]:
+    """预览回退查找用的目录列表，最多 _PREVIEW_LISTDIR_TTL 秒内复用；候选项使用前仍会 isfile/isdir 校验。"""
+    return _listdir_bucketed(root, int(time.monotonic() // _PREVIEW_LISTDIR_TTL))
+
+
+def _register_preview_root(root_real: str) -> str:
+    """登记一个预览根目录并返回新的 preview_id；越界比较用的前缀在这里算好一次。"""
+    preview_id = str(uuid.uuid4())
+    with _preview_roots_lock:
+        _preview_roots[preview_id] = (root_real, root_real.rstrip(os.sep) + os.sep)
+        while len(_preview_roots) > _PREVIEW_ROOTS_MAX:
+            _preview_roots.popitem(last=False)
+    return preview_id
+
+
+def _lookup_preview_root(preview_id: str) -> Optional[Tuple[str, str]]:
+    """取 preview_id 对应的 (根目录, 前缀)，命中时标记为最近使用；未注册或已淘汰返回 None。"""
+    with _preview_roots_lock:
+        entry = _preview_roots.get(preview_id)
+        if entry is not None:
+            _preview_roots.move_to_end(preview_id)
+        return entry
+
+
+# 只读查询类命令（不写文件、不带重定向/管道/命令串联）：模型连续给出多条时可并行执行，其余命令按原顺序逐条执行。
+# env 会执行其后的任意命令，不在其列；date/hostname 带参数可修改系统设置，printenv 一并只接受无参数形式；
+# rg 的 --pre 会为每个文件启动外部程序，带 --pre 的 rg 不算只读
+_PARALLEL_SAFE_CMD_RE = re.compile(
+    r"^(?:(?:pwd|whoami|hostname|date|printenv|sw_vers|uptime)"
+    r"|(?:ls|cat|uname|df|lscpu|free|vm_stat|head|tail|wc|file|stat|du|which|whereis|tree|diff|grep)(?:\s+[^<>|;&`$]*)?"
+    r"|rg(?:\s+(?![^<>|;&`$]*--pre)[^<>|;&`$]*)?)$"
+)
+# 仅供两条及以上只读命令组成的批次使用；npm install 等单条命令各占一个线程，不与其他会话争抢这几个工作线程
+_TERMINAL_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="term")
+
+
+def _group_run_commands(commands: List[str]) -> List[List[str]]:
+    """把命令按执行顺序分批：相邻的只读查询命令合为一批并行执行，其余命令各自单独一批，保证先后依赖不被打乱。"""
+    batches: List[List[str]] = []
+    prev_safe = False
+    for cmd in commands:
+        safe = _PARALLEL_SAFE_CMD_RE.match(cmd.strip()) is not None
+        if safe and prev_safe:
+            batches[-1].append(cmd)
+        else:
+            batches.append([cmd])
+        prev_safe = safe
+    return batches
+
+
+def _run_terminal_safely(cmd: str, cwd: Optional[str]) -> Tuple[bool, str]:
+    """执行一条助手命令（120 秒超时），异常转为失败结果，不影响同批其他命令。"""
+    try:
+        return run_assistant_terminal(cmd, cwd=cwd, timeout_sec=120)
+    except Exception as e:
+        return False, "执行异常：%s" % (getattr(e, "message", None) or str(e))
+
+
+def _start_terminal_batch(batch: List[str], cwd: Optional[str]) -> List[Future]:
+    """
+    开始执行一批命令，返回与 batch 同序的 Future 列表。
+    多条只读命令交给 _TERMINAL_POOL 并行；单条命令（可能是耗时的安装/编译）在独立的守护线程中执行。
+    """
+    if len(batch) > 1:
+        return [_TERMINAL_POOL.submit(_run_terminal_safely, c, cwd) for c in batch]
+    fut: Future = Future()
+
+    def run():
+        fut.set_result(_run_terminal_safely(batch[0], cwd))
+
+    threading.Thread(target=run, daemon=True, name="term-cmd").start()
+    return [fut]
+
+
+def _run_terminal_commands(commands: List[str], cwd: Optional[str]) -> List[Tuple[str, bool, str]]:
+    """按 _group_run_commands 的分批执行模型给出的命令，返回与输入同序的 [(命令, ok, 输出)]。"""
+    outputs: List[Tuple[str, bool, str]] = []
+    for batch in _group_run_commands(commands):
+        if len(batch) == 1:
+            results = [_run_terminal_safely(batch[0], cwd)]
+        else:
+            results = list(_TERMINAL_POOL.map(_run_terminal_safely, batch, [cwd] * len(batch)))
+        outputs.extend((c, ok, out) for c, (ok, out) in zip(batch, results))
+    return outputs
+
+
+def _direct_assistant_reply(
+    instruction: str, file_path: Optional[str], folder_path: Optional[str]
+) -> Optional[Tuple[str, str]]:
+    """
+    规则直答：指令命中简单规则时直接在本地完成并返回 (规则类别, 回复)，不再请求大模型；未命中返回 None。
+    打开文件/文件夹要求路径已由上下文或指令解析出来，且仍受桌面/项目根限制。
+    """
+    text = instruction.replace("\u3000", " ").strip()
+    if file_path and os.path.isfile(file_path) and _DIRECT_OPEN_FILE_RE.match(text):
+        ok, err = open_file_in_system(file_path)
+        return "open_file", "已经帮你打开了！" if ok else "打开失败：%s" % err
+    if folder_path and os.path.isdir(folder_path) and _DIRECT_OPEN_FOLDER_RE.match(text):
+        ok, err = open_folder_in_system(folder_path)
+        return "open_folder", "已经帮你打开了！" if ok else "打开失败：%s" % err
+    return None
+
+
+def _add_mentioned_files(mentioned_files: list, *paths: Optional[str]) -> list:
+    """
+    把新创建/修改的路径加入「对话中提到的文件」：已在列表中的跳过，空路径忽略。
+    已有路径先收进集合再逐个判断，只在确有新增时复制一次列表（不修改请求传入的原列表）。
+    """
+    paths = [p for p in paths if p]
+    if not paths:
+        return mentioned_files
+    seen = {f.get("path") or "" for f in mentioned_files}
+    result = None
+    for p in paths:
+        if p in seen:
+            continue
+        if result is None:
+            result = list(mentioned_files)
+        result.append({"path": p, "name": os.path.basename(p)})
+        seen.add(p)
+    return mentioned_files if result is None else result
+
+
+def _has_create_intent(instruction: str) -> bool:
+    """是否为创建类请求：先用一次正则扫描判断关键词，未命中再解析「在桌面/项目根创建」目标。"""
+    return bool(_CREATE_INTENT_RE.search(instruction)) or resolve_create_target_from_instruction(instruction) is not None
+
+
+def _sse_event(payload: dict) -> str:
+    """把一个事件对象编码为一帧 SSE 数据。"""
+    return "data: " + _sse_json_encode(payload) + "\n\n"
+
+
+# 逐 token 的 chunk 帧外壳固定不变，只编码 content 字段本身，不再每个 token 构造 dict 并整体编码
+_SSE_CHUNK_PREFIX = 'data: {"type": "chunk", "content": '
+_SSE_CHUNK_SUFFIX = "}\n\n"
+
+
+def _sse_chunk(content: str) -> str:
+    """编码一帧 {"type": "chunk"} 事件，输出与 _sse_event 完全一致。"""
+    return _SSE_CHUNK_PREFIX + _sse_json_encode(content) + _SSE_CHUNK_SUFFIX
+
+
+def _multi_file_preview(files: dict, max_lines: int = 30, max_chars: int = 20000) -> str:
+    """
+    多文件项目预览：按路径顺序列出每个文件的前 max_lines 行，总长超过 max_chars 时截断。
+    累计长度一旦超过上限就不再处理后面的文件，预览开销与项目总大小无关。
+    路径用堆按需逐个取出：只为实际展示的前 k 个文件付出排序代价（O(n + k log n)），不对全部路径完整排序。
+    """
+    parts: List[str] = []
+    total = -1  # 与 "\n".join(parts) 的长度保持一致（n 段有 n-1 个换行）
+    paths = list(files)
+    heapq.heapify(paths)
+    while paths:
+        fp = heapq.heappop(paths)
+        file_preview, truncated = _head_preview(files[fp], max_lines)
+        block = [f"=== {fp} ==="]
+        if file_preview:
+            block.append(file_preview)
+        if truncated:
+            block.append("... (已截断)")
+        parts.extend(block)
+        total += sum(len(b) + 1 for b in block)
+        if total > max_chars:
+            break
+    preview = "\n".join(parts)
+    if len(preview) > max_chars:
+        preview = preview[:max_chars] + "\n...(预览已截断)"
+    return preview
+
+
+# 只收不推的长时间等待（模型生成项目、执行命令）期间，至少每隔这么久（秒）发一次保活注释帧
+_SSE_KEEPALIVE_INTERVAL = 2.5
+_SSE_KEEPALIVE = ": keepalive\n\n"
+_SSE_KEEPALIVE_BYTES = _SSE_KEEPALIVE.encode("ascii")
+
+# SSE 合并下发：距上次下发不足 _SSE_BATCH_DELAY 秒的帧先攒起来，攒够 _SSE_BATCH_BYTES 也立即下发
+_SSE_BATCH_BYTES = 4096
+_SSE_BATCH_DELAY = 0.025  # 秒
+
+
+# _sse_batch 读取线程与下发端之间的结束标记
+_SSE_END = object()
+
+
+class _SseSourceError:
+    """读取线程中事件生成器抛出的异常，转交下发端重新抛出。"""
+
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def _sse_batch(events: Iterator[str]) -> Iterator[bytes]:
+    """
+    把连续到达的 SSE 帧合并成较少的几次写出，减少逐 token 的 write/flush 次数。
+    距上次下发已超过 _SSE_BATCH_DELAY 的帧（如停顿后的第一个 token）立即下发，不增加首字延迟；
+    攒在缓冲里的帧最迟在上次下发后 _SSE_BATCH_DELAY 秒内下发，不会等到下一帧到来（模型停顿时也不滞留）；
+    注释帧（": keepalive"）用于保活，总是立即下发；生成器结束时下发剩余内容。
+    事件生成器在单独的读取线程中迭代，经队列交给这里，以便按截止时间等待。
+    每批在这里一次性编码为 UTF-8 字节，WSGI 层不再逐帧编码。
+    """
+    frames: "queue.Queue" = queue.Queue()
+    stop = threading.Event()
+
+    def pump():
+        try:
+            for frame in events:
+                frames.put(frame)
+                if stop.is_set():
+                    break
+        except BaseException as e:
+            frames.put(_SseSourceError(e))
+        finally:
+            close = getattr(events, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception:
+                    pass
+            frames.put(_SSE_END)
+
+    threading.Thread(target=pump, daemon=True, name="sse-pump").start()
+
+    buf: List[str] = []
+    size = 0
+    last_flush = float("-inf")
+    try:
+        while True:
+            # 缓冲非空时只等到本批的下发截止时间；超时即把已攒的帧下发
+            timeout = max(0.0, last_flush + _SSE_BATCH_DELAY - time.monotonic()) if buf else None
+            try:
+                item = frames.get(timeout=timeout)
+            except queue.Empty:
+                yield "".join(buf).encode("utf-8")
+                buf.clear()
+                size = 0
+                last_flush = time.monotonic()
+                continue
+            if item is _SSE_END:
+                break
+            if isinstance(item, _SseSourceError):
+                if buf:
+                    yield "".join(buf).encode("utf-8")
+                    buf.clear()
+                raise item.exc
+            buf.append(item)
+            size += len(item)
+            now = time.monotonic()
+            if size >= _SSE_BATCH_BYTES or now - last_flush >= _SSE_BATCH_DELAY or item.startswith(":"):
+                # 单独的保活帧（等待期间最常见）直接下发预先编码好的字节
+                yield _SSE_KEEPALIVE_BYTES if item is _SSE_KEEPALIVE and len(buf) == 1 else "".join(buf).encode("utf-8")
+                buf.clear()
+                size = 0
+                last_flush = now
+        if buf:
+            yield "".join(buf).encode("utf-8")
+    finally:
+        # 客户端断开时通知读取线程：取到下一帧后停止并关闭事件生成器
+        stop.set()
+
+
+def _sse_response(events: Iterator[str]) -> Response:
+    """
+    把 SSE 事件生成器包装成流式响应，各流式接口共用同一份响应头，帧经 _sse_batch 合并后写出。
+    stream_with_context 包在事件生成器上：它在 _sse_batch 的读取线程中迭代，请求上下文随之带过去。
+    仍跑在 Flask 同步 WSGI 上：模型流式接口本身是阻塞迭代器，每个会话占一个工作线程；
+    X-Accel-Buffering: no 让反向代理逐帧转发，不攒满缓冲区再下发；
+    批次已是 UTF-8 字节，direct_passthrough 让 Werkzeug 原样交给服务器，不再逐项检查编码。
+    """
+    return Response(
+        _sse_batch(stream_with_context(events)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        direct_passthrough=True,
+    )
 
 
 def create_app() -> Flask:
     app = Flask(__name__, static_folder="static", template_folder="templates")
+    # 接口 JSON 不排序键、中文不转义为 \uXXXX：省去每次响应的键排序，中文内容的响应体也更小
+    app.json.sort_keys = False
+    app.json.ensure_ascii = False
 
     def start_daily_cache_cleanup():
         """
@@ -102,7 +566,9 @@ def create_app() -> Flask:
                 wait_seconds = (midnight - now).total_seconds()
                 if wait_seconds < 0:
                     wait_seconds = 60
-                time.sleep(wait_seconds)
+                # 用事件等待代替 sleep：进程退出时立即返回，而不是一直睡到午夜
+                if _background_stop.wait(wait_seconds):
+                    return
                 try:
                     logs: list[str] = []
                     clear_lumi_cache(logs)
@@ -116,26 +582,32 @@ def create_app() -> Flask:
 
     @app.route("/")
     def index():
-        devices = list_serial_devices()
-        guessed: Optional[str] = guess_esp8266_port(devices) if devices else None
+        devices, guessed = _devices_and_guess()
         return render_template("index.html", devices=devices, guessed=guessed, lumi_agent_version=LUMI_AGENT_VERSION)
 
+    # 标签页图标内容不变，启动时读入内存并算好 ETag，之后每次请求不再 stat/open 文件
+    try:
+        with open(os.path.join(app.static_folder, "title-logo.jpg"), "rb") as f:
+            favicon_bytes: Optional[bytes] = f.read()
+        favicon_etag = hashlib.md5(favicon_bytes).hexdigest()
+    except OSError:
+        favicon_bytes, favicon_etag = None, ""
+
     @app.route("/favicon.ico")
     def favicon():
         """标签页图标：很多浏览器会优先请求 /favicon.ico，此处直接返回 static/title-logo.jpg"""
-        resp = send_from_directory(
-            app.static_folder,
-            "title-logo.jpg",
-            mimetype="image/jpeg",
-        )
+        if favicon_bytes is None:
+            abort(404)
+        resp = Response(favicon_bytes, mimetype="image/jpeg")
+        resp.set_etag(favicon_etag)
         resp.headers["Cache-Control"] = "public, max-age=3600"
-        return resp
+        # 浏览器带着相同的 If-None-Match 再来请求时直接返回 304
+        return resp.make_conditional(request)
 
     @app.route("/api/devices", methods=["GET"])
     def api_devices():
         force = request.args.get("refresh", "").lower() in ("1", "true", "yes")
-        devices = list_serial_devices(force_refresh=force)
-        guessed: Optional[str] = guess_esp8266_port(devices) if devices else None
+        devices, guessed = _devices_and_guess(force_refresh=force)
         return jsonify({"devices": devices, "guessed": guessed})
 
     @app.route("/api/status", methods=["GET"])
@@ -148,11 +620,8 @@ def create_app() -> Flask:
         )
         mpremote_path = shutil.which("mpremote")
         pio_path = shutil.which(os.environ.get("PLATFORMIO", "pio"))
-        # 先探测一次可用接口并写入缓存，这样「当前模型接口」显示的是实际连上的 API
-        try:
-            _get_working_endpoint()
-        except Exception:
-            pass
+        # 接口探测放到后台线程，本次先返回已有结果；探测完成后下一次轮询即显示实际连上的 API
+        _refresh_endpoint_in_background()
         provider_info = get_model_provider_info()
         return jsonify(
             {
@@ -182,7 +651,7 @@ def create_app() -> Flask:
     @app.route("/api/developer/verify", methods=["POST"])
     def api_developer_verify():
         """开发者认证：校验密钥，正确则前端可展示开发者问候语"""
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         key = (data.get("key") or data.get("secret") or "").strip()
         secret = os.environ.get("LUMI_DEV_SECRET", "273751877MoXiaoyun")
         ok = key == secret
@@ -201,7 +670,7 @@ def create_app() -> Flask:
     @app.route("/api/toolbox/run", methods=["POST"])
     def api_toolbox_run():
         """执行指定工具箱脚本。body: { script_id, params?: {} }"""
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         script_id = (data.get("script_id") or "").strip()
         params = data.get("params") or {}
 
@@ -219,13 +688,13 @@ def create_app() -> Flask:
     @app.route("/api/code-complete", methods=["POST"])
     def api_code_complete():
         """对用户提供的源代码进行补全。body: { code, language_hint? }"""
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         code = (data.get("code") or "").strip()
         language_hint = (data.get("language_hint") or "").strip()
         if not code:
             return jsonify({"ok": False, "error": "代码不能为空"}), 400
         try:
-            result = call_qwen_code_complete(code, language_hint=language_hint)
+            result = _llm_call(call_qwen_code_complete, code, language_hint=language_hint)
             return jsonify({"ok": True, "code": result})
         except Exception as e:
             return jsonify({"ok": False, "error": str(e)}), 500
@@ -233,13 +702,13 @@ def create_app() -> Flask:
     @app.route("/api/code-optimize", methods=["POST"])
     def api_code_optimize():
         """对用户提供的源代码进行优化。body: { code, instruction? }"""
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         code = (data.get("code") or "").strip()
         instruction = (data.get("instruction") or "").strip()
         if not code:
             return jsonify({"ok": False, "error": "代码不能为空"}), 400
         try:
-            result = call_qwen_code_optimize(code, instruction=instruction)
+            result = _llm_call(call_qwen_code_optimize, code, instruction=instruction)
             return jsonify({"ok": True, "code": result})
         except Exception as e:
             return jsonify({"ok": False, "error": str(e)}), 500
@@ -256,18 +725,15 @@ def create_app() -> Flask:
 
     def _is_github_download_and_flash(text: str) -> bool:
         """判断是否为「从 GitHub 下载并烧录」类指令。"""
-        t = (text or "").lower()
-        if "github" not in t:
+        t = text or ""
+        if "github" not in t.lower():
             return False
-        if not any(k in t for k in ("下载", "拉取", "获取", "找", "搜索")):
-            return False
-        if not any(k in t for k in ("烧录", "烧写", "上传", "刷入", "写入设备")):
-            return False
-        return True
+        # 关键词均为中文，无需先转小写；每组关键词一次正则扫描
+        return bool(_GH_FETCH_RE.search(t) and _GH_FLASH_RE.search(t))
 
     @app.route("/api/run", methods=["POST"])
     def api_run():
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         instruction = (data.get("instruction") or "").strip()
         port = (data.get("port") or "").strip()
         auto_flash = bool(data.get("auto_flash", True))
@@ -281,12 +747,12 @@ def create_app() -> Flask:
         if not instruction and not reuse_code:
             return jsonify({"ok": False, "error": "指令不能为空"}), 400
 
-        devices = list_serial_devices()
+        devices, guessed = _devices_and_guess()
         if not devices:
             return jsonify({"ok": False, "error": "未检测到任何串口设备"}), 400
 
         if not port:
-            port = guess_esp8266_port(devices) or devices[0]["device"]
+            port = guessed or devices[0]["device"]
 
         logs = []
 
@@ -307,21 +773,10 @@ def create_app() -> Flask:
             else:
                 if mode == "micropython" and multi_file:
                     log("正在调用 Qwen Coder 2.5 生成多文件 MicroPython 项目...")
-                    files_dict = call_qwen_coder_multi_file(instruction)
+                    files_dict = _llm_call(call_qwen_coder_multi_file, instruction)
                     code = files_dict.get("main.py", "") or (list(files_dict.values())[0] if files_dict else "")
                     # 多文件预览：每个文件前 30 行
-                    _preview_max_lines = 30
-                    _preview_max_chars = 8000
-                    preview_parts = []
-                    for fp, content in sorted(files_dict.items()):
-                        preview_parts.append(f"=== {fp} ===")
-                        for i, line in enumerate(content.splitlines()[: _preview_max_lines], 1):
-                            preview_parts.append(f"{i:3}: {line}")
-                        if len(content.splitlines()) > _preview_max_lines:
-                            preview_parts.append("... (已截断)")
-                    preview_str = "\n".join(preview_parts)
-                    if len(preview_str) > 20000:
-                        preview_str = preview_str[:20000] + "\n...(预览已截断)"
+                    preview_str = _multi_file_preview(files_dict)
                     if auto_flash and files_dict:
                         log(f"将使用串口设备: {port}")
                         flash_micropython_files(port, files_dict, logs)
@@ -345,37 +800,23 @@ def create_app() -> Flask:
                     full_instruction = instruction + extra_hardware_context
 
                     log("正在调用 Qwen Coder 2.5 生成 MicroPython 代码...")
-                    code = call_qwen_coder(full_instruction)
+                    code = _llm_call(call_qwen_coder, full_instruction)
                 elif mode == "platformio":
                     log("正在调用 Qwen Coder 2.5 生成 C++ (PlatformIO) 工程主文件...")
-                    code = call_qwen_cpp_for_platformio(instruction)
+                    code = _llm_call(call_qwen_cpp_for_platformio, instruction)
                 else:
                     return jsonify({"ok": False, "error": f"未知模式: {mode}"}), 400
 
             # 预览前 50 行并限制总长，减小响应体积
-            _preview_max_lines = 50
-            _preview_max_chars = 12000
-            preview_lines = []
-            for i, line in enumerate(code.splitlines()[: _preview_max_lines], 1):
-                preview_lines.append(f"{i:3}: {line}")
-            preview_str = "\n".join(preview_lines)
-            if len(preview_str) > _preview_max_chars:
-                preview_str = preview_str[:_preview_max_chars] + "\n...(预览已截断)"
+            preview_str, _ = _head_preview(code, 50, max_chars=12000)
 
             if auto_flash:
                 log(f"将使用串口设备: {port}")
                 flash_micropython = mode == "micropython" or _is_github_download_and_flash(instruction)
                 if flash_micropython:
-                    tmp_path = write_temp_code(code)
-                    try:
-                        log("正在通过 mpremote 上传为 main.py ...")
-                        flash_micropython_main(port, tmp_path)
-                        log("上传完成。请重启或复位 ESP8266。")
-                    finally:
-                        try:
-                            os.remove(tmp_path)
-                        except OSError:
-                            pass
+                    log("正在通过 mpremote 上传为 main.py ...")
+                    flash_micropython_code(port, code)
+                    log("上传完成。请重启或复位 ESP8266。")
                 elif mode == "platformio":
                     build_and_upload_platformio(
                         code, port, logs, board_id=board_id, platform=platform
@@ -396,7 +837,7 @@ def create_app() -> Flask:
 
     @app.route("/api/edit-file", methods=["POST"])
     def api_edit_file():
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         relative_path = (data.get("relative_path") or "").strip()
         instruction = (data.get("instruction") or "").strip()
 
@@ -413,18 +854,16 @@ def create_app() -> Flask:
 
         try:
             log(f"准备修改桌面文件: {relative_path}")
-            new_content = edit_desktop_file(relative_path, instruction)
+            new_content = _llm_call(edit_desktop_file, relative_path, instruction)
 
             # 预览前 80 行
-            preview_lines = []
-            for i, line in enumerate(new_content.splitlines()[:80], 1):
-                preview_lines.append(f"{i:3}: {line}")
+            preview, _ = _head_preview(new_content, 80)
 
             log("文件已成功写回。")
             return jsonify(
                 {
                     "ok": True,
-                    "preview": "\n".join(preview_lines),
+                    "preview": preview,
                     "logs": logs,
                 }
             )
@@ -435,7 +874,7 @@ def create_app() -> Flask:
     @app.route("/api/edit-file/preview", methods=["POST"])
     def api_edit_file_preview():
         """AI 预览编辑：返回新内容，不写盘。body: relative_path, instruction, selected_text?, context_files? """
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         relative_path = (data.get("relative_path") or "").strip()
         instruction = (data.get("instruction") or "").strip()
         selected_text = (data.get("selected_text") or "").strip() or None
@@ -453,7 +892,8 @@ def create_app() -> Flask:
         if not instruction:
             return jsonify({"ok": False, "error": "修改需求不能为空"}), 400
         try:
-            new_content = edit_file_preview(
+            new_content = _llm_call(
+                edit_file_preview,
                 relative_path,
                 instruction,
                 selected_text=selected_text,
@@ -466,7 +906,7 @@ def create_app() -> Flask:
     @app.route("/api/edit-file/apply", methods=["POST"])
     def api_edit_file_apply():
         """将预览得到的内容写回文件。body: relative_path, new_content """
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         relative_path = (data.get("relative_path") or "").strip()
         new_content = data.get("new_content")
         if not relative_path:
@@ -486,7 +926,7 @@ def create_app() -> Flask:
 
     @app.route("/api/github-flash", methods=["POST"])
     def api_github_flash():
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         url = (data.get("url") or "").strip()
         port = (data.get("port") or "").strip()
         auto_flash = bool(data.get("auto_flash", True))
@@ -500,40 +940,31 @@ def create_app() -> Flask:
         if not url:
             return jsonify({"ok": False, "error": "GitHub 文件 URL 不能为空", "logs": logs}), 400
 
-        devices = list_serial_devices()
+        devices, guessed = _devices_and_guess()
         if not devices:
             return jsonify({"ok": False, "error": "未检测到任何串口设备", "logs": logs}), 400
 
         if not port:
-            port = guess_esp8266_port(devices) or devices[0]["device"]
+            port = guessed or devices[0]["device"]
 
         try:
             log(f"正在从 GitHub 下载文件: {url}")
             code = download_github_file(url)
 
             # 预览前 80 行
-            preview_lines = []
-            for i, line in enumerate(code.splitlines()[:80], 1):
-                preview_lines.append(f"{i:3}: {line}")
+            preview, _ = _head_preview(code, 80)
 
             if auto_flash:
                 log(f"将使用串口设备: {port}")
-                tmp_path = write_temp_code(code)
-                try:
-                    log("正在通过 mpremote 上传为 main.py ...")
-                    flash_micropython_main(port, tmp_path)
-                    log("上传完成。请重启或复位 ESP8266。")
-                finally:
-                    try:
-                        os.remove(tmp_path)
-                    except OSError:
-                        pass
+                log("正在通过 mpremote 上传为 main.py ...")
+                flash_micropython_code(port, code)
+                log("上传完成。请重启或复位 ESP8266。")
 
             return jsonify(
                 {
                     "ok": True,
                     "port": port,
-                    "preview": "\n".join(preview_lines),
+                    "preview": preview,
                     "logs": logs,
                 }
             )
@@ -544,16 +975,17 @@ def create_app() -> Flask:
     @app.route("/api/assistant/chat", methods=["POST"])
     def api_assistant_chat():
         """电脑助手对话：mode + instruction；可从指令或 context 解析文件路径，读文件后润色/修改并写回。mode=auto 时根据指令自动选择模式。"""
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         mode = (data.get("mode") or "auto").strip()
         instruction = (data.get("instruction") or "").strip()
         context = dict(data.get("context") or {})
+        no_cache = bool(data.get("no_cache"))  # 为 true 时跳过回复缓存，强制重新请求模型
         if not instruction:
             return jsonify({"ok": False, "error": "指令不能为空"}), 400
         try:
             # 最先强制识别「做…软件/App/网页/小游戏」，避免被深度思考或 resolve 未命中导致只出计划
             create_target = None
-            desktop = os.path.expanduser("~/Desktop")
+            desktop = _DESKTOP_DIR
             instr_norm = (instruction or "").replace("\u3000", " ").strip()  # 全角空格等规范化
             is_create_agent = instr_norm.startswith("【创造 Agent】") or instr_norm.startswith("【创造Agent】")
             if not is_create_agent and "做" in instr_norm:
@@ -571,8 +1003,7 @@ def create_app() -> Flask:
             file_path = context.get("file_path")
             if file_path and isinstance(file_path, str):
                 file_path = file_path.strip()
-                if file_path.startswith("~"):
-                    file_path = os.path.expanduser(file_path)
+                file_path = _expand_home(file_path)
                 file_path = os.path.normpath(file_path)
             else:
                 file_path = resolve_file_path_from_instruction(instruction)
@@ -585,11 +1016,20 @@ def create_app() -> Flask:
             folder_path = context.get("folder_path")
             if folder_path and isinstance(folder_path, str):
                 folder_path = folder_path.strip()
-                if folder_path.startswith("~"):
-                    folder_path = os.path.expanduser(folder_path)
+                folder_path = _expand_home(folder_path)
                 folder_path = os.path.normpath(folder_path)
             else:
                 folder_path = resolve_folder_path_from_instruction(instruction)
+            # 规则直答：命中时不读文件、不调模型，直接返回
+            direct = None if mode == "create_file" else _direct_assistant_reply(instruction, file_path, folder_path)
+            if direct is not None:
+                direct_kind, reply = direct
+                print("[Lumi] 规则直答:", direct_kind, flush=True)
+                mentioned_files = _add_mentioned_files(mentioned_files, file_path if direct_kind == "open_file" else None)
+                result = {"reply": reply, "mode": "direct", "file_edit": None, "mentioned_files": mentioned_files, "created_path": None, "auto_open_path": None}
+                if data.get("stream"):
+                    return _sse_response(iter([_sse_event({"type": "done", **result})]))
+                return jsonify({"ok": True, **result})
             if file_path and os.path.isfile(file_path):
                 ok_read, content, err_read = read_file_content_for_assistant(file_path)
                 if not ok_read:
@@ -603,9 +1043,8 @@ def create_app() -> Flask:
                 create_target = resolve_create_target_from_instruction(instruction)
                 if create_target is not None:
                     mode = "create_file"
-                elif re.search(r"(?:做|开发).*(?:软件|应用|App)", instruction, re.IGNORECASE):
+                elif _CREATE_APP_RE.search(instruction):
                     mode = "create_file"
-                    desktop = os.path.expanduser("~/Desktop")
                     create_target = (desktop, "写日记_项目" if "日记" in instruction else "应用_项目")
             # 若已解析到单文件，则不做 folder_edit，改为单文件编辑（避免「某文件夹里的某文件」被当成批量）
             if file_path and os.path.isfile(file_path) and mode == "folder_edit":
@@ -620,30 +1059,19 @@ def create_app() -> Flask:
                 context["folder_listing"] = entries
                 if data.get("stream"):
                     def _stream_list():
-                        import json
-                        reply = ""
+                        parts: List[str] = []
+                        chunk_frame = _sse_chunk  # 逐 token 循环内用局部名，省去每次的全局查找
                         for chunk in call_qwen_assistant_stream("list_folder", instruction, context=context):
-                            reply += chunk
-                            yield "data: " + json.dumps({"type": "chunk", "content": chunk}, ensure_ascii=False) + "\n\n"
-                        yield "data: " + json.dumps({"type": "done", "reply": reply, "mode": "list_folder", "file_edit": None, "mentioned_files": mentioned_files}, ensure_ascii=False) + "\n\n"
-                    return Response(
-                        stream_with_context(_stream_list()),
-                        mimetype="text/event-stream",
-                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
-                    )
-                reply = call_qwen_assistant("list_folder", instruction, context=context)
+                            parts.append(chunk)
+                            yield chunk_frame(chunk)
+                        reply = "".join(parts)
+                        yield _sse_event({"type": "done", "reply": reply, "mode": "list_folder", "file_edit": None, "mentioned_files": mentioned_files})
+                    return _sse_response(_stream_list())
+                reply = _llm_call(call_qwen_assistant, "list_folder", instruction, context=context)
                 return jsonify({"ok": True, "reply": reply, "mode": "list_folder", "mentioned_files": mentioned_files})
             # 文件夹内批量修改（仅当未解析到单文件时）
             if folder_path and os.path.isdir(folder_path) and mode == "folder_edit" and not (file_path and os.path.isfile(file_path)):
-                pattern = "*"
-                if re.search(r"\.py|py\s*文件|所有\s*\.?py", instruction, re.IGNORECASE):
-                    pattern = "*.py"
-                elif re.search(r"\.txt|txt\s*文件|所有\s*\.?txt", instruction, re.IGNORECASE):
-                    pattern = "*.txt"
-                else:
-                    m = re.search(r"\.(js|ts|jsx|tsx|html|css)", instruction, re.IGNORECASE)
-                    if m:
-                        pattern = "*." + m.group(1).lower()
+                pattern = _folder_edit_pattern(instruction)
                 ok_f, folder_files, err_f = read_folder_files_for_assistant(folder_path, pattern=pattern, max_files=20)
                 if not ok_f:
                     return jsonify({"ok": False, "error": err_f}), 400
@@ -653,11 +1081,8 @@ def create_app() -> Flask:
                 context["folder_files"] = folder_files
                 if data.get("stream"):
                     def _stream_folder_edit():
-                        import json
-                        yield "data: " + json.dumps({"type": "chunk", "content": "正在修改文件…"}, ensure_ascii=False) + "\n\n"
-                        reply = ""
-                        for chunk in call_qwen_assistant_stream("folder_edit", instruction, context=context):
-                            reply += chunk
+                        yield _sse_chunk("正在修改文件…")
+                        reply = "".join(call_qwen_assistant_stream("folder_edit", instruction, context=context))
                         allowed = {rel for rel, _ in folder_files}
                         parsed = _parse_multi_file_output(reply)
                         edits = {k: v for k, v in parsed.items() if k in allowed}
@@ -668,13 +1093,9 @@ def create_app() -> Flask:
                             final_reply = "覆写失败"
                         else:
                             final_reply = reply
-                        yield "data: " + json.dumps({"type": "done", "reply": final_reply, "mode": "folder_edit", "file_edit": None, "mentioned_files": mentioned_files}, ensure_ascii=False) + "\n\n"
-                    return Response(
-                        stream_with_context(_stream_folder_edit()),
-                        mimetype="text/event-stream",
-                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
-                    )
-                reply = call_qwen_assistant("folder_edit", instruction, context=context)
+                        yield _sse_event({"type": "done", "reply": final_reply, "mode": "folder_edit", "file_edit": None, "mentioned_files": mentioned_files})
+                    return _sse_response(_stream_folder_edit())
+                reply = _llm_call(call_qwen_assistant, "folder_edit", instruction, context=context)
                 allowed = {rel for rel, _ in folder_files}
                 parsed = _parse_multi_file_output(reply)
                 edits = {k: v for k, v in parsed.items() if k in allowed}
@@ -695,13 +1116,22 @@ def create_app() -> Flask:
                     target_dir = os.path.normpath(os.path.join(base_dir, folder_name))
                     if data.get("stream"):
                         def _stream_create_file():
-                            import json
                             mentioned_files = data.get("context", {}).get("mentioned_files") or []
                             # 只收不推：模型输出用于解析写文件，不发给用户；只发一句「正在生成…」和最后的「已经帮你创建好了！」
-                            yield "data: " + json.dumps({"type": "chunk", "content": "正在生成项目…"}, ensure_ascii=False) + "\n\n"
-                            reply = ""
-                            for chunk in call_qwen_assistant_stream("create_file", instruction, context=context):
-                                reply += chunk
+                            yield _sse_chunk("正在生成项目…")
+                            cache_key, cached = _cached_reply("create_file", instruction, context, no_cache)
+                            if cached is not None:
+                                reply = cached
+                            else:
+                                parts: List[str] = []
+                                now = time.monotonic
+                                keepalive_at = now() + _SSE_KEEPALIVE_INTERVAL
+                                for chunk in call_qwen_assistant_stream("create_file", instruction, context=context):
+                                    parts.append(chunk)
+                                    if now() >= keepalive_at:
+                                        yield _SSE_KEEPALIVE
+                                        keepalive_at = now() + _SSE_KEEPALIVE_INTERVAL
+                                reply = "".join(parts)
                             parsed = _parse_multi_file_output(reply)
                             if not parsed:
                                 content = extract_content_to_write_from_reply(reply) or extract_html_from_reply(reply)
@@ -710,6 +1140,8 @@ def create_app() -> Flask:
                             if parsed:
                                 progress_list = []
                                 ok_create, create_errors = ensure_directory_and_write_files(target_dir, parsed, progress_callback=progress_list.append)
+                                if ok_create and cache_key and cached is None:
+                                    set_cached_llm_reply(cache_key, reply)
                                 status = "已经帮你创建好了！" if ok_create else "创建失败"
                                 final_reply = ("\n".join(progress_list) + "\n" + status) if progress_list else status
                                 created_path = target_dir if ok_create else None
@@ -721,21 +1153,17 @@ def create_app() -> Flask:
                             run_commands = extract_run_commands_from_reply(reply)
                             run_cwd = created_path if (created_path and os.path.isdir(created_path)) else None
                             if run_commands:
-                                term_outputs = []
-                                for run_cmd in run_commands:
-                                    ok_term, term_out = run_assistant_terminal(run_cmd, cwd=run_cwd, timeout_sec=120)
-                                    term_outputs.append((run_cmd, ok_term, term_out))
+                                term_outputs = _run_terminal_commands(run_commands, run_cwd)
                                 lines = [("已执行：%s\n[输出]\n%s" % (c, o) if ok else "执行失败：%s\n%s" % (c, o)) for c, ok, o in term_outputs]
                                 final_reply = final_reply + "\n\n" + "\n\n".join(lines) if final_reply else "\n\n".join(lines)
-                            if created_path and not any((f.get("path") or "") == created_path for f in mentioned_files):
-                                mentioned_files = list(mentioned_files) + [{"path": created_path, "name": os.path.basename(created_path)}]
-                            yield "data: " + json.dumps({"type": "done", "reply": final_reply, "mode": "create_file", "file_edit": None, "mentioned_files": mentioned_files, "created_path": created_path, "auto_open_path": auto_open_path}, ensure_ascii=False) + "\n\n"
-                        return Response(
-                            stream_with_context(_stream_create_file()),
-                            mimetype="text/event-stream",
-                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
-                        )
-                    reply = call_qwen_assistant("create_file", instruction, context=context)
+                            mentioned_files = _add_mentioned_files(mentioned_files, created_path)
+                            yield _sse_event({"type": "done", "reply": final_reply, "mode": "create_file", "file_edit": None, "mentioned_files": mentioned_files, "created_path": created_path, "auto_open_path": auto_open_path})
+                        return _sse_response(_stream_create_file())
+                    cache_key, cached = _cached_reply("create_file", instruction, context, no_cache)
+                    if cached is not None:
+                        reply = cached
+                    else:
+                        reply = _llm_call(call_qwen_assistant, "create_file", instruction, context=context)
                     parsed = _parse_multi_file_output(reply)
                     if not parsed:
                         content = extract_content_to_write_from_reply(reply) or extract_html_from_reply(reply)
@@ -744,6 +1172,8 @@ def create_app() -> Flask:
                     if parsed:
                         progress_list = []
                         ok_create, create_errors = ensure_directory_and_write_files(target_dir, parsed, progress_callback=progress_list.append)
+                        if ok_create and cache_key and cached is None:
+                            set_cached_llm_reply(cache_key, reply)
                         status = "已经帮你创建好了！" if ok_create else "创建失败"
                         reply = ("\n".join(progress_list) + "\n" + status) if progress_list else status
                     else:
@@ -753,14 +1183,10 @@ def create_app() -> Flask:
                     run_commands = extract_run_commands_from_reply(reply)
                     run_cwd = created_path if (created_path and os.path.isdir(created_path)) else None
                     if run_commands:
-                        term_outputs = []
-                        for run_cmd in run_commands:
-                            ok_term, term_out = run_assistant_terminal(run_cmd, cwd=run_cwd, timeout_sec=120)
-                            term_outputs.append((run_cmd, ok_term, term_out))
+                        term_outputs = _run_terminal_commands(run_commands, run_cwd)
                         lines = [("已执行：%s\n[输出]\n%s" % (c, o) if ok else "执行失败：%s\n%s" % (c, o)) for c, ok, o in term_outputs]
                         reply = reply + "\n\n" + "\n\n".join(lines) if reply else "\n\n".join(lines)
-                    if created_path and not any((f.get("path") or "") == created_path for f in mentioned_files):
-                        mentioned_files = list(mentioned_files) + [{"path": created_path, "name": os.path.basename(created_path)}]
+                    mentioned_files = _add_mentioned_files(mentioned_files, created_path)
                     return jsonify({
                         "ok": True,
                         "reply": reply,
@@ -771,38 +1197,45 @@ def create_app() -> Flask:
                     })
             if data.get("stream"):
                 def _stream_default():
-                    import json
                     file_edit_info = None
                     created_path = None
                     auto_open_path = None
                     mentioned_files = data.get("context", {}).get("mentioned_files") or []
+                    cache_key, cached = None, None
                     try:
                         # 创建类请求：只做创建，只回复「已经帮你创建好了！」或「创建失败」，不向用户展示任何其他文本
-                        create_intent = resolve_create_target_from_instruction(instruction) is not None or (
-                            ("做" in instruction or "开发" in instruction)
-                            and any(x in instruction for x in ["网站", "软件", "应用", "网页", "小游戏"])
-                        ) or "app" in instruction.lower()
+                        create_intent = _has_create_intent(instruction)
                         reply = ""
                         if create_intent:
-                            yield "data: " + json.dumps({"type": "chunk", "content": "正在生成项目…"}, ensure_ascii=False) + "\n\n"
-                            last_keepalive = time.time()
-                            for chunk in call_qwen_assistant_stream(mode, instruction, context=context):
-                                reply += chunk
-                                if time.time() - last_keepalive > 2.5:
-                                    yield ": keepalive\n\n"
-                                    last_keepalive = time.time()
+                            yield _sse_chunk("正在生成项目…")
+                            cache_key, cached = _cached_reply(mode, instruction, context, no_cache)
+                            if cached is not None:
+                                reply = cached
+                            else:
+                                parts: List[str] = []
+                                now = time.monotonic
+                                keepalive_at = now() + _SSE_KEEPALIVE_INTERVAL
+                                for chunk in call_qwen_assistant_stream(mode, instruction, context=context):
+                                    parts.append(chunk)
+                                    if now() >= keepalive_at:
+                                        yield _SSE_KEEPALIVE
+                                        keepalive_at = now() + _SSE_KEEPALIVE_INTERVAL
+                                reply = "".join(parts)
                         else:
+                            parts = []
+                            chunk_frame = _sse_chunk  # 逐 token 循环内用局部名，省去每次的全局查找
                             for chunk in call_qwen_assistant_stream(mode, instruction, context=context):
-                                reply += chunk
-                                yield "data: " + json.dumps({"type": "chunk", "content": chunk}, ensure_ascii=False) + "\n\n"
+                                parts.append(chunk)
+                                yield chunk_frame(chunk)
+                            reply = "".join(parts)
                     except Exception as e:
                         reply = "请求出错（模型或网络异常）：%s" % (getattr(e, "message", None) or str(e))
                     try:
                         # 模型自主决定创建：回复中含 ---FILE:--- 时，解析并写入桌面文件夹
-                        if "---FILE:" in (reply or "").upper():
+                        if _FILE_MARKER_RE.search(reply or ""):
                             post_target = resolve_create_target_from_instruction(instruction)
                             if not post_target:
-                                post_target = (os.path.expanduser("~/Desktop"), "新建项目")
+                                post_target = (_DESKTOP_DIR, "新建项目")
                             base_dir, folder_name = post_target
                             target_dir = os.path.normpath(os.path.join(base_dir, folder_name))
                             parsed = _parse_multi_file_output(reply)
@@ -814,22 +1247,26 @@ def create_app() -> Flask:
                                 progress_list = []
                                 ok_create, _ = ensure_directory_and_write_files(target_dir, parsed, progress_callback=progress_list.append)
                                 if ok_create:
+                                    if cache_key and cached is None:
+                                        set_cached_llm_reply(cache_key, reply)
                                     status = "已经帮你创建好了！"
                                     reply = ("\n".join(progress_list) + "\n" + status) if progress_list else status
                                     created_path = target_dir
                                     auto_open_path = os.path.join(target_dir, "index.html") if "index.html" in parsed else target_dir
                         # 禁止在对话中展示代码：若回复含代码块/HTML 但未走 ---FILE:---，仍提取保存并只回复简短确认
-                        if created_path is None and reply and ("```" in reply or "<!DOCTYPE" in reply.upper() or "<html" in reply.lower()):
+                        if created_path is None and reply and _CODE_MARKER_RE.search(reply):
                             content = extract_html_from_reply(reply) or extract_content_to_write_from_reply(reply)
                             if content and len(content) > 100:
                                 post_target = resolve_create_target_from_instruction(instruction)
                                 if not post_target:
-                                    post_target = (os.path.expanduser("~/Desktop"), "新建项目")
+                                    post_target = (_DESKTOP_DIR, "新建项目")
                                 base_dir, folder_name = post_target
                                 target_dir = os.path.normpath(os.path.join(base_dir, folder_name))
                                 progress_list = []
                                 ok_create, _ = ensure_directory_and_write_files(target_dir, {"index.html": content}, progress_callback=progress_list.append)
                                 if ok_create:
+                                    if cache_key and cached is None:
+                                        set_cached_llm_reply(cache_key, reply)
                                     status = "已经帮你创建好了！"
                                     reply = ("\n".join(progress_list) + "\n" + status) if progress_list else status
                                     created_path = target_dir
@@ -848,24 +1285,31 @@ def create_app() -> Flask:
                         run_cwd = created_path if (create_intent and created_path and os.path.isdir(created_path)) else None
                         if run_commands:
                             term_outputs = []
-                            for i, run_cmd in enumerate(run_commands):
-                                yield "data: " + json.dumps({"type": "status", "message": "正在执行命令 (%d/%d)…" % (i + 1, len(run_commands))}, ensure_ascii=False) + "\n\n"
-                                term_result = [None]
-                                def _run_term(cmd=run_cmd):
-                                    try:
-                                        term_result[0] = run_assistant_terminal(cmd, cwd=run_cwd, timeout_sec=120)
-                                    except Exception as e:
-                                        term_result[0] = (False, "执行异常：%s" % (getattr(e, "message", None) or str(e)))
-                                t = threading.Thread(target=_run_term)
-                                t.start()
-                                while t.is_alive():
-                                    yield ": keepalive\n\n"
-                                    time.sleep(2.5)
-                                res = term_result[0]
-                                if res is None:
-                                    res = (False, "执行超时或未返回结果")
-                                ok_term, term_out = res
-                                term_outputs.append((run_cmd, ok_term, term_out))
+                            total = len(run_commands)
+                            for batch in _group_run_commands(run_commands):
+                                first = len(term_outputs) + 1
+                                if len(batch) == 1:
+                                    status_msg = "正在执行命令 (%d/%d)…" % (first, total)
+                                else:
+                                    status_msg = "正在并行执行命令 (%d-%d/%d)…" % (first, first + len(batch) - 1, total)
+                                yield _sse_event({"type": "status", "message": status_msg})
+                                futures = _start_terminal_batch(batch, run_cwd)
+                                cmd_of = dict(zip(futures, batch))
+                                pending = set(futures)
+                                finished = len(term_outputs)
+                                # 每有一条命令结束就下发一次「已完成」状态；等待超时则发保活帧
+                                while pending:
+                                    done, pending = futures_wait(pending, timeout=_SSE_KEEPALIVE_INTERVAL, return_when=FIRST_COMPLETED)
+                                    if not done:
+                                        yield _SSE_KEEPALIVE
+                                        continue
+                                    for fut in done:
+                                        finished += 1
+                                        yield _sse_event({"type": "status", "message": "已完成 %s (%d/%d)" % (cmd_of[fut], finished, total)})
+                                # 汇总输出仍按模型给出的命令顺序
+                                for c, fut in zip(batch, futures):
+                                    ok_term, term_out = fut.result()
+                                    term_outputs.append((c, ok_term, term_out))
                             lines = []
                             for cmd, ok, out in term_outputs:
                                 lines.append(("已执行：%s\n[输出]\n%s" % (cmd, out)) if ok else ("执行失败：%s\n%s" % (cmd, out)))
@@ -873,32 +1317,27 @@ def create_app() -> Flask:
                         # 创建类请求只允许以这两句之一结尾，其余一律视为「创建失败」
                         if create_intent and not (reply or "").strip().endswith("已经帮你创建好了！") and not (reply or "").strip().endswith("创建失败"):
                             reply = "创建失败"
-                        if created_path and not any((f.get("path") or "") == created_path for f in mentioned_files):
-                            mentioned_files = list(mentioned_files) + [{"path": created_path, "name": os.path.basename(created_path)}]
-                        if file_edit_info:
-                            p = file_edit_info.get("path") or ""
-                            if p and not any((f.get("path") or "") == p for f in mentioned_files):
-                                mentioned_files = list(mentioned_files) + [{"path": p, "name": os.path.basename(p)}]
+                        mentioned_files = _add_mentioned_files(
+                            mentioned_files, created_path, (file_edit_info or {}).get("path")
+                        )
                     except Exception as e:
                         reply = (reply or "") + "\n\n[处理过程出错] %s" % (getattr(e, "message", None) or str(e))
-                    yield "data: " + json.dumps({"type": "done", "reply": reply, "mode": mode, "file_edit": file_edit_info, "mentioned_files": mentioned_files, "created_path": created_path, "auto_open_path": auto_open_path}, ensure_ascii=False) + "\n\n"
-                return Response(
-                    stream_with_context(_stream_default()),
-                    mimetype="text/event-stream",
-                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
-                )
-            reply = call_qwen_assistant(mode, instruction, context=context)
+                    yield _sse_event({"type": "done", "reply": reply, "mode": mode, "file_edit": file_edit_info, "mentioned_files": mentioned_files, "created_path": created_path, "auto_open_path": auto_open_path})
+                return _sse_response(_stream_default())
             file_edit_info = None
             created_path = None
             auto_open_path = None
-            create_intent = resolve_create_target_from_instruction(instruction) is not None or (
-                ("做" in instruction or "开发" in instruction)
-                and any(x in instruction for x in ["网站", "软件", "应用", "网页", "小游戏"])
-            ) or "app" in instruction.lower()
-            if "---FILE:" in (reply or "").upper():
+            create_intent = _has_create_intent(instruction)
+            # 创建类请求可复用之前成功创建过的同一回复
+            cache_key, cached = _cached_reply(mode, instruction, context, no_cache) if create_intent else (None, None)
+            if cached is not None:
+                reply = cached
+            else:
+                reply = _llm_call(call_qwen_assistant, mode, instruction, context=context)
+            if _FILE_MARKER_RE.search(reply or ""):
                 post_target = resolve_create_target_from_instruction(instruction)
                 if not post_target:
-                    post_target = (os.path.expanduser("~/Desktop"), "新建项目")
+                    post_target = (_DESKTOP_DIR, "新建项目")
                 base_dir, folder_name = post_target
                 target_dir = os.path.normpath(os.path.join(base_dir, folder_name))
                 parsed = _parse_multi_file_output(reply)
@@ -910,21 +1349,25 @@ def create_app() -> Flask:
                     progress_list = []
                     ok_create, _ = ensure_directory_and_write_files(target_dir, parsed, progress_callback=progress_list.append)
                     if ok_create:
+                        if cache_key and cached is None:
+                            set_cached_llm_reply(cache_key, reply)
                         status = "已经帮你创建好了！"
                         reply = ("\n".join(progress_list) + "\n" + status) if progress_list else status
                         created_path = target_dir
                         auto_open_path = os.path.join(target_dir, "index.html") if "index.html" in parsed else target_dir
-            if created_path is None and reply and ("```" in reply or "<!DOCTYPE" in reply.upper() or "<html" in reply.lower()):
+            if created_path is None and reply and _CODE_MARKER_RE.search(reply):
                 content = extract_html_from_reply(reply) or extract_content_to_write_from_reply(reply)
                 if content and len(content) > 100:
                     post_target = resolve_create_target_from_instruction(instruction)
                     if not post_target:
-                        post_target = (os.path.expanduser("~/Desktop"), "新建项目")
+                        post_target = (_DESKTOP_DIR, "新建项目")
                     base_dir, folder_name = post_target
                     target_dir = os.path.normpath(os.path.join(base_dir, folder_name))
                     progress_list = []
                     ok_create, _ = ensure_directory_and_write_files(target_dir, {"index.html": content}, progress_callback=progress_list.append)
                     if ok_create:
+                        if cache_key and cached is None:
+                            set_cached_llm_reply(cache_key, reply)
                         status = "已经帮你创建好了！"
                         reply = ("\n".join(progress_list) + "\n" + status) if progress_list else status
                         created_path = target_dir
@@ -946,21 +1389,15 @@ def create_app() -> Flask:
             run_commands = extract_run_commands_from_reply(reply)
             run_cwd = created_path if (create_intent and created_path and os.path.isdir(created_path)) else None
             if run_commands:
-                term_outputs = []
-                for run_cmd in run_commands:
-                    ok_term, term_out = run_assistant_terminal(run_cmd, cwd=run_cwd, timeout_sec=120)
-                    term_outputs.append((run_cmd, ok_term, term_out))
+                term_outputs = _run_terminal_commands(run_commands, run_cwd)
                 lines = [("已执行：%s\n[输出]\n%s" % (c, o) if ok else "执行失败：%s\n%s" % (c, o)) for c, ok, o in term_outputs]
                 reply = reply + "\n\n" + "\n\n".join(lines) if reply else "\n\n".join(lines)
             # 创建类请求只允许以这两句之一结尾，其余一律视为「创建失败」
             if create_intent and not (reply or "").strip().endswith("已经帮你创建好了！") and not (reply or "").strip().endswith("创建失败"):
                 reply = "创建失败"
-            if created_path and not any((f.get("path") or "") == created_path for f in mentioned_files):
-                mentioned_files = list(mentioned_files) + [{"path": created_path, "name": os.path.basename(created_path)}]
-            if file_edit_info:
-                p = file_edit_info.get("path") or ""
-                if p and not any((f.get("path") or "") == p for f in mentioned_files):
-                    mentioned_files = list(mentioned_files) + [{"path": p, "name": os.path.basename(p)}]
+            mentioned_files = _add_mentioned_files(
+                mentioned_files, created_path, (file_edit_info or {}).get("path")
+            )
             return jsonify({"ok": True, "reply": reply, "mode": mode, "file_edit": file_edit_info, "mentioned_files": mentioned_files, "created_path": created_path, "auto_open_path": auto_open_path})
         except Exception as e:
             return jsonify({"ok": False, "error": str(e)}), 500
@@ -968,7 +1405,7 @@ def create_app() -> Flask:
     @app.route("/api/assistant/open-file", methods=["POST"])
     def api_assistant_open_file():
         """用系统默认应用打开文件。body: path（绝对路径，仅允许桌面或项目根下）。"""
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         path = (data.get("path") or "").strip()
         if not path:
             return jsonify({"ok": False, "error": "缺少 path"}), 400
@@ -978,7 +1415,7 @@ def create_app() -> Flask:
     @app.route("/api/assistant/open-folder", methods=["POST"])
     def api_assistant_open_folder():
         """在系统文件管理器中打开目录；若 path 为文件则打开其所在目录。body: path。"""
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         path = (data.get("path") or "").strip()
         if not path:
             return jsonify({"ok": False, "error": "缺少 path"}), 400
@@ -988,7 +1425,7 @@ def create_app() -> Flask:
     @app.route("/api/assistant/open-in-xcode", methods=["POST"])
     def api_assistant_open_in_xcode():
         """用 Xcode 打开工程。body: path（项目目录或 .xcodeproj 路径）。"""
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         path = (data.get("path") or "").strip()
         if not path:
             return jsonify({"ok": False, "error": "缺少 path"}), 400
@@ -998,7 +1435,7 @@ def create_app() -> Flask:
     @app.route("/api/assistant/read-file", methods=["POST"])
     def api_assistant_read_file():
         """读取文件内容供前端预览。仅允许桌面或项目根下的文件。body: path。"""
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         path = (data.get("path") or "").strip()
         if not path:
             return jsonify({"ok": False, "error": "缺少 path"}), 400
@@ -1010,32 +1447,31 @@ def create_app() -> Flask:
     @app.route("/api/assistant/register-preview-root", methods=["POST"])
     def api_assistant_register_preview_root():
         """注册一个项目目录供网页内预览，返回 preview_id。body: path（目录或 index.html 等文件的绝对路径；若为文件则用其所在目录）。"""
-        global _preview_roots
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         path = (data.get("path") or "").strip()
         if not path:
             return jsonify({"ok": False, "error": "缺少 path"}), 400
-        path = os.path.normpath(os.path.expanduser(path))
+        path = os.path.normpath(_expand_home(path))
         root = path
         if os.path.isfile(path):
             root = os.path.dirname(path)
         elif not os.path.isdir(path):
             return jsonify({"ok": False, "error": "路径不存在"}), 400
-        if not is_path_under_allowed_bases(root):
+        # 校验与解析共用一次（带短时缓存的）realpath；解析结果随 preview_id 保存，之后逐个静态文件请求不再解析根目录
+        root_real = resolve_allowed_path(root)
+        if root_real is None:
             return jsonify({"ok": False, "error": "仅允许预览桌面或项目根下的目录"}), 400
-        root_real = os.path.realpath(root)
-        preview_id = str(uuid.uuid4())
-        _preview_roots[preview_id] = root_real
+        preview_id = _register_preview_root(root_real)
         return jsonify({"ok": True, "preview_id": preview_id})
 
     @app.route("/api/assistant/serve-app/<preview_id>/")
     @app.route("/api/assistant/serve-app/<preview_id>/<path:subpath>")
     def api_assistant_serve_app(preview_id: str, subpath: str = ""):
         """为网页内预览提供静态文件。preview_id 由 register-preview-root 返回，便于 iframe 内相对请求（如 script.js）携带同一 id。"""
-        global _preview_roots
-        if not preview_id or preview_id not in _preview_roots:
+        entry = _lookup_preview_root(preview_id) if preview_id else None
+        if entry is None:
             return Response("预览已失效或未注册", status=404, mimetype="text/plain")
-        root = _preview_roots[preview_id]
+        root, root_prefix = entry
         subpath = (subpath or "").strip().lstrip("/")
         if ".." in subpath or subpath.startswith(".."):
             return Response("非法路径", status=403, mimetype="text/plain")
@@ -1044,14 +1480,14 @@ def create_app() -> Flask:
         file_path = os.path.join(root, subpath)
         try:
             file_path = os.path.normpath(file_path)
-            if not file_path.startswith(root + os.sep) and file_path != root:
+            if not file_path.startswith(root_prefix) and file_path != root:
                 return Response("非法路径", status=403, mimetype="text/plain")
         except (TypeError, ValueError):
             return Response("非法路径", status=403, mimetype="text/plain")
         if not os.path.isfile(file_path) and subpath == "index.html":
             # 项目根没有 index.html 时，尝试用目录下任意 .html 作为入口
             try:
-                for name in sorted(os.listdir(root)):
+                for name in _cached_listdir(root):
                     if name.lower().endswith(".html"):
                         fallback = os.path.join(root, name)
                         if os.path.isfile(fallback):
@@ -1062,28 +1498,20 @@ def create_app() -> Flask:
         if not os.path.isfile(file_path):
             # 若是 Xcode 项目，返回说明页而非“文件不存在”
             try:
-                for name in os.listdir(root):
+                for name in _cached_listdir(root):
                     if name.endswith(".xcodeproj") and os.path.isdir(os.path.join(root, name)):
-                        html = (
-                            "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Xcode 项目</title></head><body style=\"font-family:system-ui;padding:2rem;max-width:36em;margin:0 auto;\">"
-                            "<h2>这是 Xcode 项目</h2>"
-                            "<p>iOS/macOS 应用无法在浏览器中预览。</p>"
-                            "<p>请关闭本窗口，在右侧「对话中提到的文件」中点击<strong>「打开」</strong>在 Finder 中打开该文件夹，然后双击 <code>.xcodeproj</code> 用 Xcode 打开并运行。</p>"
-                            "<p>或点击<strong>「用 Xcode 打开」</strong>直接启动 Xcode 并打开该工程。</p>"
-                            "</body></html>"
-                        )
-                        return Response(html, status=200, mimetype="text/html; charset=utf-8")
+                        return Response(_XCODE_PREVIEW_HTML, status=200, mimetype="text/html; charset=utf-8")
             except OSError:
                 pass
             return Response("文件不存在（该目录下无 index.html 或其它 .html 文件）", status=404, mimetype="text/plain; charset=utf-8")
-        directory = os.path.dirname(file_path)
-        filename = os.path.basename(file_path)
-        return send_from_directory(directory, filename)
+        # 路径已在上面校验过不越出预览根，直接 send_file：带 ETag/Last-Modified，iframe 刷新时未改动的文件返回 304；
+        # max_age=0 要求每次回源校验，保证改完文件刷新即可看到；服务器支持 wsgi.file_wrapper 时由其零拷贝发送
+        return send_file(file_path, conditional=True, max_age=0)
 
     @app.route("/api/assistant/terminal", methods=["POST"])
     def api_assistant_terminal():
         """执行助手生成的终端命令（白名单内）。body: command, cwd?, timeout?"""
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         command = (data.get("command") or "").strip()
         cwd = (data.get("cwd") or "").strip() or None
         timeout = int(data.get("timeout") or 60)
@@ -1099,7 +1527,7 @@ def create_app() -> Flask:
         一键生成并烧录基础无人机飞控框架代码（示例用途）。
         说明：这里生成的是一个教学/演示用的飞控框架，占位实现，不直接用于真实飞行。
         """
-        data = request.get_json(force=True) or {}
+        data = _json_body()
         port = (data.get("port") or "").strip()
         auto_flash = bool(data.get("auto_flash", True))
 
@@ -1109,12 +1537,12 @@ def create_app() -> Flask:
             logs.append(msg)
             print(msg)
 
-        devices = list_serial_devices()
+        devices, guessed = _devices_and_guess()
         if not devices:
             return jsonify({"ok": False, "error": "未检测到任何串口设备", "logs": logs}), 400
 
         if not port:
-            port = guess_esp8266_port(devices) or devices[0]["device"]
+            port = guessed or devices[0]["device"]
 
         try:
             # 固定的飞控框架需求说明
@@ -1128,31 +1556,23 @@ def create_app() -> Flask:
             )
 
             log("正在为基础无人机飞控生成 MicroPython 框架代码...")
-            code = call_qwen_coder(instruction)
+            code = _llm_call(call_qwen_coder, instruction)
 
-            # 预览前 80 行
-            preview_lines = []
-            for i, line in enumerate(code.splitlines()[:80], 1):
-                preview_lines.append(f"{i:3}: {line}")
+            # 预览前 80 行（只扫描到第 80 行为止）
+            preview, _ = _head_preview(code, 80)
 
             if auto_flash:
                 log(f"将使用串口设备: {port}")
-                tmp_path = write_temp_code(code)
-                try:
-                    log("正在通过 mpremote 上传为 main.py ...")
-                    flash_micropython_main(port, tmp_path)
-                    log("上传完成。请重启或复位 ESP8266。")
-                finally:
-                    try:
-                        os.remove(tmp_path)
-                    except OSError:
-                        pass
+                log("正在通过 mpremote 上传为 main.py ...")
+                # 小文件随 exec 直接写入，不落地临时文件；大文件才由 flash_micropython_code 内部走临时文件 + cp
+                flash_micropython_code(port, code)
+                log("上传完成。请重启或复位 ESP8266。")
 
             return jsonify(
                 {
                     "ok": True,
                     "port": port,
-                    "preview": "\n".join(preview_lines),
+                    "preview": preview,
                     "logs": logs,
                 }
             )